@@ -10,12 +10,13 @@
 
 import numpy as np
 from utils import ligthcurve_helper as lcHelper
+from utils import cache_helper as cacheHelper
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.lines as lines
 
 
-lc = np.loadtxt("../variability/Cyg X-1.csv", delimiter=",")
+lc = cacheHelper.loadtxt("../variability/Cyg X-1.csv", delimiter=",")
 
 # Lines plot for each channel and total energy
 for col_idx in range(3, len(lc[0, :])):
@@ -24,7 +25,7 @@ for col_idx in range(3, len(lc[0, :])):
 plt.show()
 
 # Draws the energy data from Cyg X-1 vs Sco X-1
-lcSco = np.loadtxt("../variability/Sco X-1.csv", delimiter=",")
+lcSco = cacheHelper.loadtxt("../variability/Sco X-1.csv", delimiter=",")
 
 plt.plot(lc[ : , len(lc[0, :]) - 1 ]) # Blue
 plt.plot(lcSco[ : , len(lcSco[0, :]) - 1 ]) # Orange
@@ -14,7 +14,7 @@
 # ALGORITHM STEPS:
 # 0-  Get image scale and scale MRSC array by the scale and the degrees
 #     per MRSC element factors. The scaling is based on biliniar interpolation.
-# 1 - Calculates the GTIs excluding when the Sun is inside the FOV
+# 1 - Calculates the GTIs excluding when the Sun, Moon or Earth are inside the FOV
 # 2 - Loads the ligthcurve and removes the data outside GTIs
 # 3 - Loads the attitude data
 # 4 - Define output image size
@@ -53,139 +53,28 @@
 #     Note: All the Dec (Declination) values in the algorithm has added 90 to work in
 #     range 0..180 instead of -90..90 in order to be able to use them as array indices
 
-import os
-import numpy as np
-from utils import ligthcurve_helper as lcHelper
-from utils import attitude_helper as attHelper
-from utils import img_helper as imgHelper
-from utils import hist
-from utils import gti as gtiHelper
-import matplotlib
-import matplotlib.pyplot as plt
+from utils.allsky_pipeline import AllSkyPipeline
 import constants as consts
 
-# Calculates the GTIs including the Sun is outside the FOV
-solar_gtis = lcHelper.get_gtis_from_file(consts.TP_SOLAR_FILE,
-                                        consts.TP_SOLAR_THRESHOLD)
+pipeline = AllSkyPipeline(mode="counts")
 
-gtis = gtiHelper.cross_gtis([solar_gtis, consts.GTIS])
+# Calculates the GTIs, loads the ligthcurve and the attitude data, projects
+# the observations and calculates the calibrated and equalized maps
+pipeline.run("equalize")
 
-# Loads the ligthcurve and removes the data outside GTIs
-lc = lcHelper.get_ligthcurve(consts.LC_FILE)
-lc = lcHelper.filter_by_gti(lc, gtis)
-
-# Loads the attitude data
-att = attHelper.load_attitude(consts.ATT_FILE)
-
-print ("- Input data is ready.")
-
-# Define output image size
-height = int(180.0 * consts.IMG_SCALE) # 180 from Declination range
-width = int(360.0 * consts.IMG_SCALE) # 360 from Right Ascension range
-
-# Prepare allsky´s energy and exposure data arrays
-img_total_counts_map = np.zeros((height, width))
-img_exposure_map = np.zeros((height, width))
-
-# Draw each observation on its location inside the counts and exposure maps
-for i in range(0, len(lc[:, 0])):
-
-    counts = lcHelper.get_total_counts(lc[i,:])
-
-    if counts >= consts.MIN_COUNTS and counts != 0:
-        coords = attHelper.get_ra_dec(lc[i, consts.LC_TIME_COL], att)
-        ra_int = int(coords[0] * consts.IMG_SCALE)
-        dec_int = int((coords[1] + 90.0) * consts.IMG_SCALE)
-
-        img_total_counts_map = imgHelper.drawFOV(ra_int, dec_int, counts,
-                                                img_total_counts_map,
-                                                exposure_map=img_exposure_map)
-
-print ("- Counts and exposure data ready, preparing computed counts map.")
-
-# Calculates the computed counts map image
-img_comp_counts_map = np.zeros((height, width))
-for dec in range(0, height):
-    for ra in range(0, width):
-        if img_exposure_map[dec, ra] > consts.MIN_EXPOSURE:
-            img_comp_counts_map[dec, ra] = img_total_counts_map[dec, ra] / img_exposure_map[dec, ra]
-
-# Calculates the min and max computed counts
-min_counts = np.min(img_comp_counts_map)
-max_counts = np.max(img_comp_counts_map) - min_counts
-
-# Calibrate each pixel value in range 0..255
-for dec in range(0, height):
-    for ra in range(0, width):
-        img_comp_counts_map[dec, ra] = int(((img_comp_counts_map[dec, ra] - min_counts) / max_counts) * consts.COLORS)
-
-
-# Show Expousure, Counts, Computed Counts and Equalized data plots
+# Show Expousure, Counts, Flux and Equalized data plots
 # =====================================================
 if consts.SHOW_PLOTS:
-
-    plt.title("Exposure Map")
-    plt.imshow(img_exposure_map)
-    plt.colorbar()
-    plt.annotate('SCO X-1', xy=(244.979 * consts.IMG_SCALE, (-15.640 + 90) * consts.IMG_SCALE),
-                 xycoords='data', xytext=(0.5, 0.5), textcoords='figure fraction',
-                 arrowprops=dict(arrowstyle="->"))
-    plt.annotate('Cyg X-1', xy=(299.59 * consts.IMG_SCALE, (35.20 + 90) * consts.IMG_SCALE),
-                 xycoords='data', xytext=(0.75, 0.75), textcoords='figure fraction',
-                 arrowprops=dict(arrowstyle="->"))
-    plt.show()
-
-
-    plt.title("Counts Map")
-    plt.imshow(img_total_counts_map)
-    plt.colorbar()
-    plt.show()
-
-
-    plt.title("All Sky Plot")
-    plt.imshow(img_comp_counts_map)
-    plt.colorbar()
-    plt.show()
-
-
-#Img equalization
-if consts.EQUALIZE_IMAGE:
-    img_comp_counts_map = hist.histeq(img_comp_counts_map)
-
-    if consts.SHOW_PLOTS:
-        plt.title("All Sky Equalized Plot")
-        plt.imshow(img_comp_counts_map)
-        plt.colorbar()
-        plt.annotate('SCO X-1', xy=(244.979 * consts.IMG_SCALE, (-15.640 + 90) * consts.IMG_SCALE),
-                     xycoords='data', xytext=(0.5, 0.5), textcoords='figure fraction',
-                     arrowprops=dict(arrowstyle="->"))
-        plt.annotate('Cyg X-1', xy=(299.59 * consts.IMG_SCALE, (35.20 + 90) * consts.IMG_SCALE),
-                     xycoords='data', xytext=(0.75, 0.75), textcoords='figure fraction',
-                     arrowprops=dict(arrowstyle="->"))
-        plt.show()
-
+    pipeline.show_plots()
 
 # Extract clipped images and save as Fits Images
 # =====================================================
-if consts.WRITE_FITS_FILES:
-    clip_angle = 4 # Half (radious, not diameter) of the clipped images´s size in degrees
-    clip_angle2 = clip_angle * 2 # Total angular size of the clipped image
-    scaled_clip_angle = clip_angle * consts.IMG_SCALE
-    deg_px_ratio = (1.0 + 0.1)/consts.IMG_SCALE # 0.1 for overlaying margin (for Aladin HiPS Gen)
-
-    # Clip images and save as Fits
-    for dec in xrange(clip_angle, 180, clip_angle2):
-        for ra in xrange(clip_angle, 360, clip_angle2):
-            ra_int = int(ra * consts.IMG_SCALE)
-            dec_int = int(dec * consts.IMG_SCALE)
+pipeline.run("export")
 
-            clipped_img = np.array(img_comp_counts_map[ dec_int - scaled_clip_angle : dec_int + scaled_clip_angle,
-                                   ra_int - scaled_clip_angle : ra_int + scaled_clip_angle ], dtype=np.uint8)
-
-            avg = int(np.average(clipped_img))
-            min = int(np.min(clipped_img))
-            max = int(np.max(clipped_img))
+# Save the image as a HiPS (WRITE_HIPS)
+# =====================================================
+pipeline.run("hips")
 
-            #FILENAME: /DEC_RA_AVG_MIN_MAX.fits
-            filename = consts.OUTPUT_FOLDER + 'fits_' + str(dec) + '_' + str(ra) + '_' + str(avg) + '_' + str(min) + '_' + str(max) + '.fits'
-            imgHelper.saveImage (clipped_img, ra, dec - 90, deg_px_ratio, filename)
+# Measure the fluxes of the catalogue sources (PHOTOMETRY_FILE)
+# =====================================================
+pipeline.run("photometry")
@@ -9,6 +9,15 @@
 # Path of the file with the ligthcurve (time and counts) data in csv format
 LC_FILE = "../Data/Be.dat"
 
+# The NASA PDS XRFS tables can be used as LC_FILE too (ex: "../Data/NASA/A15C_XRFS_71_EXTENDED_2.tab"),
+# the channel counts of these detectors are summed: "DET1", "DET2", "DET3" and/or "SM" (see utils/pds_helper.py).
+# LC_BACKGROUND and MIN_COUNTS are for one detector, as Be.dat, scale them if more detectors are summed
+LC_PDS_DETECTORS = [ "DET1" ]
+
+# Number of rows of LC_FILE read and projected at once, for ligthcurves larger than
+# the memory. None for loading the whole file
+STREAM_CHUNK_SIZE = None
+
 # Good time intervals: [[start_1, end_1], ... ,[start_N, end_N]]
 GTIS = [[224.0, 288.0]]
         #  Cyg X-1 TimeRange: [[246.444977, 247.599548]];
@@ -24,7 +33,7 @@ LC_TIME_BIN = 8
 LC_FLAG_COL = 1
 
 # Index of the column with the first channel data in the lc file. Next channels must be consecutives.
-LC_FIRST_CHANNEL_COL = 2
+LC_FIRST_CHANNEL_COL = 2
 
 # Number of channel´s data columns in the lc file
 LC_NUM_CHANNELS = 8
@@ -32,6 +41,12 @@ LC_NUM_CHANNELS = 8
 # Note: Customize LC_FIRST_CHANNEL_COL and LC_NUM_CHANNELS in order to create
 #       AllSky Fits for only one channel, or different channel ranges.
 
+# Channels summed for the All Sky maps, as indices from LC_FIRST_CHANNEL_COL
+# (ex: [7] or [0, 1, 2, 3]). None for all the LC_NUM_CHANNELS channels.
+# Note: All the channels are projected at once, so changing only this value
+#       doesn't need a new projection.
+LC_BAND_CHANNELS = None
+
 # Background data array, one element per channel
 LC_BACKGROUND = [ 69.38, 20.14, 28.76, 35.45, 32.90, 36.42, 32.86, 139.92 ]
 
@@ -118,6 +133,26 @@ TP_SOLAR_FILE = "../Data/Sun-theta_phi.txt"
 # With solar angles below this threshold will be dissmised
 TP_SOLAR_THRESHOLD = 32.0
 
+# Paths of the files with the moon and earth position data (GET(Time)[h], theta[deg], phi[deg]) in csv format
+TP_MOON_FILE = "../Data/Moon-theta_phi.txt"
+TP_EARTH_FILE = "../Data/Earth-theta_phi.txt"
+
+# With moon or earth angles below these thresholds will be dissmised, None for not using them
+TP_MOON_THRESHOLD = None
+TP_EARTH_THRESHOLD = None
+
+# BODY-Theta_Phi file of each body
+TP_BODY_FILES = { "SUN": TP_SOLAR_FILE, "MOON": TP_MOON_FILE, "EARTH": TP_EARTH_FILE }
+
+# Path of the file with the sun, moon and earth position data
+# (GET(Time)[h], theta_SUN[deg], phi_SUN[deg], theta_MOON[deg], phi_MOON[deg], theta_EARTH[deg], phi_EARTH[deg]) in csv format
+# (ex: "../Data/NASA/TEC_A15/TEC_thetaphi_sme.txt"), used instead of the BODY-Theta_Phi files.
+# None for using the BODY-Theta_Phi files
+TP_SME_FILE = None
+
+# Theta column index of each body in the TP_SME_FILE
+TP_SME_THETA_COLS = { "SUN": 1, "MOON": 3, "EARTH": 5 }
+
 
 
 #====================================
@@ -130,6 +165,24 @@ OUTPUT_FOLDER = "../output/HiPS_RGB/Apollo15_XRFS_Be_AllSkyFits_Channels7_8_EQ/"
 # Sets the resolution of the output image -> Scale * (360x180)px
 IMG_SCALE = 4
 
+# Method for projecting the observations over the energy and exposure maps:
+#   "scatter": projects the MRSC over each observation.
+#   "direct" or "fft": bins the observations first and then applies the MRSC
+#                      once, directly or by FFT convolution.
+#   "spherical": bins the observations first and then applies the MRSC rotated on
+#                the sphere to each Dec row, correct at high Declinations.
+#   "auto": "direct" or "fft" depending on the MRSC size and the pixels with observations.
+PROJECTION_METHOD = "auto"
+
+# Pixelization of the energy and exposure maps:
+#   "car": RA/Dec grid of (180 x 360) * IMG_SCALE pixels, using PROJECTION_METHOD.
+#   "healpix": HEALPix NESTED map of HEALPIX_NSIDE (see utils/healpix_map_helper.py),
+#              converted to the RA/Dec grid for plotting and for the Fits files.
+PROJECTION_BACKEND = "car"
+
+# Nside of the HEALPix maps, power of 2. None for the lowest with pixels smaller than the IMG_SCALE ones
+HEALPIX_NSIDE = None
+
 # Sets the color scale range. Must be 255 if using equalization.
 COLORS = 255.0
 
@@ -142,8 +195,80 @@ SHOW_PLOTS = True
 # Equalize all sky image before exporting to Fits files
 EQUALIZE_IMAGE = True
 
+# Stretch function used for equalizing the all sky image:
+# "histeq", "linear", "sqrt", "log", "asinh" or "percentile" (see utils/hist.py)
+STRETCH = "histeq"
+
 # If True writes the all sky image as Fits files in the output folder
 WRITE_FITS_FILES = True
 
+# Number of worker processes for writing the Fits files, 1 for writing them sequentially
+EXPORT_WORKERS = 4
+
 # If True replaces the zeros by ones in the Fits files data to avoid transparent color in Aladin HipsGen
 GEN_ALADIN_READY_FITS = True
+
+# If True writes the all sky image directly as a HiPS in HIPS_FOLDER (must exist),
+# without the Aladin HipsGen step (see utils/hips_helper.py)
+WRITE_HIPS = False
+HIPS_FOLDER = "../output/HiPS/Apollo15_XRFS_Be_Channels7_8_EQ/"
+
+# Deepest HiPS order, None for choosing it from IMG_SCALE
+HIPS_ORDER = None
+
+# Width of the HiPS tiles in pixels, must be a power of 2
+HIPS_TILE_WIDTH = 512
+
+# Formats of the HiPS tiles: "fits" and/or "png"
+HIPS_FORMATS = [ "fits", "png" ]
+HIPS_TITLE = "Apollo 15 XRFS All Sky Map"
+
+
+#====================================
+# Variability section
+#====================================
+
+# Sizes in degrees (integers) of the sky pixels of the variability analysis (see pixelVariability.py)
+VARIABILITY_PIX_SIZES = [ 2, 5, 10, 20 ]
+
+# Energies not above this value are not included in the time series of the pixels
+VARIABILITY_MIN_ENERGY = 0.02
+
+# Folder of the variability outputs, each pixel size is saved in pixSize{size}/
+VARIABILITY_FOLDER = "../variability/"
+
+# Catalogue of X-ray sources (CSV with Name, RA, Dec) for extracting their ligthcurves
+# (see extractSources.py), annotating the plots and measuring their fluxes, and the
+# folder of the ligthcurves
+CATALOG_FILE = "../Data/sources.csv"
+SOURCES_FOLDER = "../variability/sources/"
+
+# Forced photometry of the CATALOG_FILE sources over the all sky maps (see utils/photometry_helper.py):
+# "bilinear" or "aperture" (weighted by the MRSC centered on the source)
+PHOTOMETRY_METHOD = "aperture"
+
+# CSV file of the photometry, written after generating the maps. None for not writing it
+PHOTOMETRY_FILE = "../output/photometry.csv"
+
+
+#====================================
+# Cache section
+#====================================
+
+# Folder for the parsed data files (see utils/cache_helper.py), created if not exists.
+# None for parsing the files every time
+CACHE_FOLDER = "../cache/"
+
+# Folder for the outputs of the AllSkyPipeline stages, so they are only recomputed
+# when the constants they depend on change, also between runs. None for not caching them
+STAGE_CACHE_FOLDER = "../cache/stages/"
+
+# Max size in bytes of the STAGE_CACHE_FOLDER, the least recently used outputs are removed
+STAGE_CACHE_MAX_SIZE = 2 << 30
+
+# Checkpoint file (.npz) of the binned observations of the projection (see
+# utils/sky_accumulator.py), saved every CHECKPOINT_INTERVAL chunks of the ligthcurve.
+# The next runs only bin the new rows and the rows inside changed GTIs.
+# None for binning the whole ligthcurve every run
+CHECKPOINT_FILE = None
+CHECKPOINT_INTERVAL = 10
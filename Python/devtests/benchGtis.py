@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Benchmark of the GTI crossing with synthetic GTI lists of up to 10^5 intervals,
+# compared with the original pairwise crossing (only up to BASELINE_MAX_INTERVALS,
+# as it is quadratic). Both must give the same GTIs.
+
+import time
+import numpy as np
+from utils import gti as gtiHelper
+
+N_INTERVALS = [ 1000, 10000, 100000 ]
+N_LISTS = [ 2, 4 ]
+BASELINE_MAX_INTERVALS = 10000
+
+
+# Original cross_two_gtis: for each end time, looks for the last start of both
+# lists before it and checks that no interval of the other list closes between them
+def baseline_cross_two_gtis(gti0, gti1):
+
+    gti0 = gtiHelper.join_equal_gti_boundaries(np.asarray(gti0))
+    gti1 = gtiHelper.join_equal_gti_boundaries(np.asarray(gti1))
+    gtiHelper.check_gtis(gti0)
+    gtiHelper.check_gtis(gti1)
+
+    gti_start = [gti0[:, 0], gti1[:, 0]]
+    gti_end = [gti0[:, 1], gti1[:, 1]]
+
+    conc_start = np.concatenate((gti0[:, 0], gti1[:, 0]))
+    conc_end = np.concatenate((gti0[:, 1], gti1[:, 1]))
+    conc_tag = np.concatenate((np.zeros(len(gti0), dtype=bool), np.ones(len(gti1), dtype=bool)))
+
+    order = np.argsort(conc_end)
+    conc_start = conc_start[order]
+    conc_end = conc_end[order]
+    conc_tag = conc_tag[order]
+
+    last_end = conc_start[0] - 1
+    final_gti = []
+    for ie, e in enumerate(conc_end):
+        # Plain ints: recent numpy no longer accepts numpy bools as list indices
+        this_series = int(conc_tag[ie])
+        other_series = 1 - this_series
+
+        try:
+            st_pos = np.argmax(gti_start[this_series][gti_start[this_series] < e])
+            so_pos = np.argmax(gti_start[other_series][gti_start[other_series] < e])
+            st = gti_start[this_series][st_pos]
+            so = gti_start[other_series][so_pos]
+
+            s = np.max([st, so])
+        except:
+            continue
+
+        if s <= last_end:
+            continue
+
+        cond1 = (gti_end[other_series] > s) * (gti_end[other_series] < e)
+        cond2 = gti_end[other_series][so_pos] < s
+        if not np.any(np.logical_or(cond1, cond2)):
+            final_gti.append([s, e])
+            last_end = e
+
+    return np.array(final_gti).reshape((-1, 2))
+
+
+# Original cross_gtis: crosses the lists one by one
+def baseline_cross_gtis(gti_list):
+
+    gti0 = gti_list[0]
+    for gti in gti_list[1:]:
+        gti0 = baseline_cross_two_gtis(gti0, gti)
+
+    return gti0
+
+
+# Returns n random non overlapping GTIs. Bounds are continuous so different lists
+# never share a boundary: the original crossing reports the single common time of
+# two touching intervals as a GTI
+def random_gtis(n, rng):
+    bounds = np.sort(rng.uniform(0, n * 20, 2 * n))
+    return bounds.reshape((n, 2))
+
+
+rng = np.random.RandomState(0)
+
+for n_lists in N_LISTS:
+    for n in N_INTERVALS:
+        gti_list = [ random_gtis(n, rng) for i in range(n_lists) ]
+
+        start = time.time()
+        gtis = gtiHelper.cross_gtis(gti_list)
+        elapsed = time.time() - start
+
+        result = "lists: " + str(n_lists) + ", intervals: " + str(n) \
+                 + ", crossed: " + str(len(gtis)) + ", time: " + str(round(elapsed, 4)) + "s"
+
+        if n <= BASELINE_MAX_INTERVALS:
+            start = time.time()
+            baseline_gtis = baseline_cross_gtis(gti_list)
+            baseline_elapsed = time.time() - start
+
+            assert np.array_equal(gtis.reshape((-1, 2)), baseline_gtis), "GTIs differ from the baseline"
+
+            result += ", baseline time: " + str(round(baseline_elapsed, 4)) + "s" \
+                      + ", speedup: " + str(round(baseline_elapsed / max(elapsed, 1e-9), 1)) + "x"
+
+        print(result)
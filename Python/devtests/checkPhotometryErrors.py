@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Checks the photometry errors against a synthetic count map. Every observation
+# has the same gross counts on each channel, so the projected variance map is the
+# variance of one observation times the exposure map and the error of a source
+# with exposure e must be sqrt(variance / e), for both modes, backends and
+# photometry methods, whatever the MRSC ratios. The previous estimate
+# sqrt(value / exposure) is printed for comparison, it ignored the background
+# and the squared channel energies.
+
+import numpy as np
+from utils import ligthcurve_helper as lcHelper
+from utils import sky_accumulator as skyAcc
+from utils import allsky_pipeline as pipeline
+from utils import photometry_helper as photHelper
+import constants as consts
+
+N_OBSERVATIONS = 20000
+SOURCES_RAS = np.array([ 30.0, 150.0, 270.0 ])
+SOURCES_DECS = np.array([ 0.0, 45.0, -70.0 ])
+
+rng = np.random.RandomState(0)
+
+# Gross counts of each channel, well above the background
+background = np.asarray(consts.LC_BACKGROUND[:consts.LC_NUM_CHANNELS])
+gross_counts = np.ceil(background) + 50.0
+
+# Ligthcurve with the same counts on every row, in normal mode
+data = np.zeros((N_OBSERVATIONS, consts.LC_FIRST_CHANNEL_COL + consts.LC_NUM_CHANNELS))
+data[:, consts.LC_TIME_COL] = np.arange(N_OBSERVATIONS) * consts.LC_TIME_BIN
+data[:, consts.LC_FLAG_COL] = consts.NORMAL_MODE
+data[:, consts.LC_FIRST_CHANNEL_COL:] = gross_counts
+lc = lcHelper.Ligthcurve(data)
+
+# Pointings scattered around the sources
+source_idx = rng.randint(len(SOURCES_RAS), size=N_OBSERVATIONS)
+ras = (SOURCES_RAS[source_idx] + rng.normal(0.0, 3.0, N_OBSERVATIONS)) % 360.0
+decs = np.clip(SOURCES_DECS[source_idx] + rng.normal(0.0, 3.0, N_OBSERVATIONS), -89.9, 89.9)
+
+for mode in pipeline.MODES:
+
+    values, variances, valid = pipeline.AllSkyPipeline(mode).get_values(lc)
+    assert np.all(valid), "All the observations must be valid"
+
+    # Poisson variance of the total value of one observation
+    if mode == "energy":
+        channel_energies = np.asarray(consts.CHANNEL_ENERGIES[:consts.LC_NUM_CHANNELS])
+        variance = np.sum(gross_counts * (channel_energies / consts.LC_TIME_BIN) ** 2)
+    else:
+        variance = np.sum(gross_counts)
+
+    for backend in skyAcc.BACKENDS:
+
+        accumulator = skyAcc.SkyAccumulator(2 * consts.LC_NUM_CHANNELS, backend=backend)
+        accumulator.add(ras, decs, np.column_stack((values, variances)))
+        cube, exposure_map = accumulator.get_maps()
+
+        values_map = np.sum(cube[:consts.LC_NUM_CHANNELS], axis=0)
+        variance_map = np.sum(cube[consts.LC_NUM_CHANNELS:], axis=0)
+
+        for method in photHelper.PHOTOMETRY_METHODS:
+
+            photometry = photHelper.forced_photometry(values_map, variance_map, exposure_map,
+                                                      SOURCES_RAS, SOURCES_DECS, method=method)
+            exposures = photometry["exposure"]
+            assert np.all(exposures > consts.MIN_EXPOSURE), "The sources must have exposure"
+
+            expected = np.sqrt(variance / exposures)
+            previous = np.sqrt(np.abs(photometry["value"]) / exposures)
+
+            print(mode + ", " + backend + ", " + method + ": errors " + str(photometry["error"])
+                  + ", expected " + str(expected) + ", previous estimate " + str(previous))
+
+            assert np.allclose(photometry["error"], expected, rtol=1e-6), "Errors differ from the expected ones"
@@ -0,0 +1,36 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Extracts the ligthcurve of each source of the CATALOG_FILE: the observations
+# whose FOV contains the source, with the same columns as lcBeWithCoords.csv plus
+# the MRSC ratio of the source in the observation (Weight).
+# Saves one CSV file per source in SOURCES_FOLDER (see utils/source_helper.py)
+
+import numpy as np
+from utils import ligthcurve_helper as lcHelper
+from utils import attitude_helper as attHelper
+from utils import source_helper as srcHelper
+from utils import cache_helper as cacheHelper
+import constants as consts
+
+
+lc = lcHelper.get_ligthcurve(consts.LC_FILE)
+att = attHelper.load_attitude(consts.ATT_FILE)
+catalog = srcHelper.load_catalog(consts.CATALOG_FILE)
+
+# The samples without attitude are dismissed
+covered = attHelper.get_coverage_mask(lc[:, consts.LC_TIME_COL], att)
+attHelper.warn_uncovered(len(lc) - np.count_nonzero(covered))
+lc = lc[covered]
+
+ras, decs = attHelper.get_ra_dec_array(lc[:, consts.LC_TIME_COL], att)
+data = np.column_stack((lc, lcHelper.Ligthcurve(lc).sum_of_energies, ras, decs))
+
+sources_rows = srcHelper.get_source_rows(catalog, data, ras, decs)
+
+cacheHelper.make_folder(consts.SOURCES_FOLDER)
+
+for source, rows in zip(catalog, sources_rows):
+    print(source["name"] + ": " + str(len(rows)) + " observations")
+    np.savetxt(consts.SOURCES_FOLDER + source["name"] + ".csv", rows, delimiter=",", fmt='%10.6f',
+               header='Time, Mode, Ch0, Ch1, Ch2, Ch3, Ch4, Ch5, Ch6, Ch7, Total, RA, DEC, Weight')
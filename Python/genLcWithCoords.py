@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 # Creates a CSV file with the data of the LC FILE plus coordinates
-# and total energy columns
+# and total energy columns. The LC FILE is read in chunks of
+# STREAM_CHUNK_SIZE rows, each one is written before reading the next one
 # Author: Ricardo Vallés Blanco (Timelab Technologies)
 
 import numpy as np
@@ -11,23 +12,31 @@ from utils import attitude_helper as attHelper
 import constants as consts
 
 
-lc = lcHelper.get_ligthcurve(consts.LC_FILE)
 att = attHelper.load_attitude(consts.ATT_FILE)
 
-n_samples = len(lc[:, 0])
+with open("../variability/lcBeWithCoords.csv", "w") as csv_file:
 
-N = len(lc[0, :])
-result = np.zeros((n_samples, N+3))
-result[:,:-3] = lc
+    header = 'Time, Mode, Ch0, Ch1, Ch2, Ch3, Ch4, Ch5, Ch6, Ch7, Total, RA, DEC'
 
-for i in range(0, n_samples):
-    time = lc[i, 0]
-    coords = attHelper.get_ra_dec(time, att)
+    uncovered = 0
+    for lc in lcHelper.iter_ligthcurve_chunks(consts.LC_FILE, consts.STREAM_CHUNK_SIZE):
 
-    total_energy = lcHelper.get_sum_of_energies(lc[i,:])
+        # The samples without attitude are dismissed
+        covered = attHelper.get_coverage_mask(lc[:, 0], att)
+        uncovered += len(lc) - np.count_nonzero(covered)
+        lc = lc[covered]
 
-    result[i, -3] = total_energy
-    result[i, -2] = coords[0]
-    result[i, -1] = coords[1]
+        n_samples = len(lc[:, 0])
 
-np.savetxt("../variability/lcBeWithCoords.csv", result, delimiter=",", fmt='%10.6f', header='Time, Mode, Ch0, Ch1, Ch2, Ch3, Ch4, Ch5, Ch6, Ch7, Total, RA, DEC')
+        N = lc.shape[1]
+        result = np.zeros((n_samples, N+3))
+        result[:,:-3] = lc
+
+        result[:, -3] = lcHelper.Ligthcurve(lc).sum_of_energies
+
+        result[:, -2], result[:, -1] = attHelper.get_ra_dec_array(lc[:, 0], att)
+
+        np.savetxt(csv_file, result, delimiter=",", fmt='%10.6f', header=header)
+        header = ''
+
+attHelper.warn_uncovered(uncovered)
@@ -0,0 +1,411 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# ALLSKY PIPELINE
+# ===============================================
+# Generates the all sky maps as a sequence of stages:
+#
+#   gtis -> ligthcurve -> projection -> band -> finalize -> equalize -> export
+#                         attitude  --^         \                   \-> hips
+#                                                \-> photometry
+#
+# The projection stage projects every channel of the ligthcurve in a single
+# pass to a cube of maps (channels x H x W) with a shared exposure map. The
+# band stage sums the cube maps of the LC_BAND_CHANNELS, so any combination
+# of channels is obtained without projecting again. The Poisson variances of
+# the values of each channel are projected in the same pass to a variance cube,
+# used for the photometry errors.
+#
+# The ligthcurve is read in chunks of STREAM_CHUNK_SIZE rows (see
+# ligthcurve_helper.LigthcurveChunks) and the projection stage bins each chunk
+# on the maps before reading the next one (see sky_accumulator), so the memory
+# used doesn't grow with the length of the ligthcurve. If CHECKPOINT_FILE is set
+# the bins are saved every CHECKPOINT_INTERVAL chunks, and the next runs only bin
+# the rows not binned yet (new rows or an interrupted run) and the rows added or
+# removed by a change of the GTIs.
+#
+# The output of each stage is kept in memory together with a signature of
+# the constants.py values it depends on and the signatures of its input
+# stages. When a stage is requested again it is only recomputed if its
+# signature has changed, so after changing a constant (directly or with
+# set_params) only the affected stages are rerun. The signatures of the stages
+# that read files include the modification time and size of the files.
+#
+# The outputs of the CACHED_STAGES are also saved on disk by signature (see
+# cache_helper.save_stage), so they are reused by the next runs and scripts
+# with the same constants. The inputs of a stage are only computed (or loaded)
+# if its output is not cached, so changing only the stretch loads the finalize
+# output and only the equalize stage is run.
+#
+# Backends (PROJECTION_BACKEND):
+#   car: the maps are RA/Dec grids of (180 x 360) * IMG_SCALE pixels.
+#   healpix: the maps are HEALPix NESTED vectors of HEALPIX_NSIDE pixels. They are
+#            converted to the RA/Dec grid for plotting and for the Fits files,
+#            and written directly in the HiPS.
+#
+# Modes:
+#   energy: projects the sum of the channel energies of each observation and
+#           calibrates the flux map with its max value.
+#   counts: projects the background corrected counts of the observations with
+#           total counts >= MIN_COUNTS and calibrates with the min and max values.
+#           The total counts are the sum of all the LC_NUM_CHANNELS channels.
+
+import hashlib
+import numpy as np
+from utils import ligthcurve_helper as lcHelper
+from utils import attitude_helper as attHelper
+from utils import img_helper as imgHelper
+from utils import hips_helper as hipsHelper
+from utils import healpix_map_helper as hpMapHelper
+from utils import sky_accumulator as skyAcc
+from utils import source_helper as srcHelper
+from utils import photometry_helper as photHelper
+from utils import hist
+from utils import gti as gtiHelper
+from utils import cache_helper as cacheHelper
+import constants as consts
+
+MODES = [ "energy", "counts" ]
+
+# Version of the stage outputs, the cached outputs of other versions are not used.
+# Increase it when the outputs change without changes in the constants
+STAGE_VERSION = 1
+
+# Constants used by each stage
+STAGE_PARAMS = {
+    "gtis": [ "GTIS", "TP_SOLAR_THRESHOLD", "TP_MOON_THRESHOLD", "TP_EARTH_THRESHOLD",
+              "TP_BODY_FILES", "TP_SME_FILE", "TP_SME_THETA_COLS" ],
+    "ligthcurve": [ "LC_FILE", "LC_PDS_DETECTORS", "STREAM_CHUNK_SIZE", "LC_TIME_COL", "LC_TIME_BIN", "LC_FLAG_COL",
+                    "LC_FIRST_CHANNEL_COL", "LC_NUM_CHANNELS", "LC_BACKGROUND",
+                    "NORMAL_MODE", "EXTENDED_MODE", "EXTENDED_MODE_FACTOR",
+                    "CHANNEL_ENERGIES", "SUPPORTED_MODES", "MIN_COUNTS" ],
+    "attitude": [ "ATT_FILE", "ATT_HEADER_ROWS", "ATT_TIME_COL", "ATT_RA_COL", "ATT_DEC_COL" ],
+    "projection": [ "IMG_SCALE", "FOV", "PROJECTION_METHOD", "PROJECTION_BACKEND", "HEALPIX_NSIDE" ],
+    "band": [ "LC_BAND_CHANNELS" ],
+    "finalize": [ "MIN_EXPOSURE", "COLORS" ],
+    "equalize": [ "EQUALIZE_IMAGE", "STRETCH" ],
+    "export": [ "WRITE_FITS_FILES", "OUTPUT_FOLDER", "GEN_ALADIN_READY_FITS" ],
+    "hips": [ "WRITE_HIPS", "HIPS_FOLDER", "HIPS_ORDER", "HIPS_TILE_WIDTH", "HIPS_FORMATS",
+              "HIPS_TITLE", "MIN_EXPOSURE" ],
+    "photometry": [ "CATALOG_FILE", "PHOTOMETRY_METHOD", "PHOTOMETRY_FILE", "MIN_EXPOSURE" ]
+}
+
+# Input stages of each stage
+STAGE_INPUTS = {
+    "gtis": [],
+    "ligthcurve": [ "gtis" ],
+    "attitude": [],
+    "projection": [ "ligthcurve", "attitude" ],
+    "band": [ "projection" ],
+    "finalize": [ "band" ],
+    "equalize": [ "finalize" ],
+    "export": [ "equalize" ],
+    "hips": [ "equalize", "band" ],
+    "photometry": [ "band" ]
+}
+
+# Constants with the paths of the files read by each stage
+STAGE_FILES = {
+    "gtis": [ "TP_BODY_FILES", "TP_SME_FILE" ],
+    "ligthcurve": [ "LC_FILE" ],
+    "attitude": [ "ATT_FILE" ],
+    "photometry": [ "CATALOG_FILE" ]
+}
+
+# Stages whose outputs are cached on disk. The ligthcurve and attitude are read
+# through the data files cache, and export and hips write files
+CACHED_STAGES = [ "gtis", "projection", "band", "finalize", "equalize" ]
+
+STAGES = [ "gtis", "ligthcurve", "attitude", "projection", "band", "finalize", "equalize", "export", "hips",
+           "photometry" ]
+
+# Constants read by img_helper when imported, they can't be changed with set_params
+FIXED_PARAMS = [ "IMG_SCALE", "FOV", "MRSC" ]
+
+
+class AllSkyPipeline(object):
+
+    def __init__(self, mode="energy"):
+
+        if mode not in MODES:
+            raise ValueError("Unknown mode: " + str(mode))
+
+        self.mode = mode
+        self.results = {}
+        self.signatures = {}
+        self.files = {}
+
+    # Sets the given constants.py values, the stages that use them will be
+    # recomputed the next time they are requested
+    def set_params(self, **params):
+        for name in params:
+            if not hasattr(consts, name):
+                raise ValueError("Unknown parameter: " + name)
+            if name in FIXED_PARAMS and params[name] != getattr(consts, name):
+                raise ValueError("Parameter can't be changed: " + name)
+            setattr(consts, name, params[name])
+
+    # Returns the signature of a stage from its constants, files and the
+    # signatures of its inputs
+    def get_signature(self, stage):
+        values = [ stage, self.mode, STAGE_VERSION ]
+        values.extend([ repr(getattr(consts, name)) for name in STAGE_PARAMS[stage] ])
+        values.extend([ repr(self.get_files_state(name)) for name in STAGE_FILES.get(stage, []) ])
+        values.extend([ self.get_signature(input_stage) for input_stage in STAGE_INPUTS[stage] ])
+        return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()
+
+    # Returns the state of the files of a constant with a path or a dict of paths
+    def get_files_state(self, name):
+        paths = getattr(consts, name)
+        if paths is None:
+            return None
+        if isinstance(paths, dict):
+            return [ (key, cacheHelper.get_file_state(paths[key])) for key in sorted(paths) ]
+        return cacheHelper.get_file_state(paths)
+
+    # Returns the output of a stage, computing it and its inputs only if needed
+    def get(self, stage):
+
+        if stage not in STAGE_INPUTS:
+            raise ValueError("Unknown stage: " + str(stage))
+
+        signature = self.get_signature(stage)
+
+        if self.signatures.get(stage) != signature:
+            result = cacheHelper.load_stage(stage, signature) if stage in CACHED_STAGES else None
+
+            if result is None:
+                inputs = [ self.get(input_stage) for input_stage in STAGE_INPUTS[stage] ]
+                result = getattr(self, "run_" + stage)(*inputs)
+                if stage in CACHED_STAGES:
+                    cacheHelper.save_stage(stage, signature, result)
+
+            self.results[stage] = result
+            self.signatures[stage] = signature
+
+        return self.results[stage]
+
+    # Runs all the stages until the given one, included
+    def run(self, until="export"):
+        return self.get(until)
+
+    # Calculates the GTIs including the Sun, Moon and Earth are outside the FOV,
+    # from the TP_SME_FILE if it is set or else from the BODY-Theta_Phi files
+    def run_gtis(self):
+
+        bodies_gtis = lcHelper.get_bodies_gtis({ "SUN": consts.TP_SOLAR_THRESHOLD,
+                                                 "MOON": consts.TP_MOON_THRESHOLD,
+                                                 "EARTH": consts.TP_EARTH_THRESHOLD },
+                                               path=consts.TP_SME_FILE)
+
+        return gtiHelper.cross_gtis([bodies_gtis, consts.GTIS])
+
+    # Returns the data loaded from a file, loading it only the first time
+    def load_file(self, load, path):
+        key = (load.__name__, path)
+        if key not in self.files:
+            self.files[key] = load(path)
+        return self.files[key]
+
+    # Returns the ligthcurve chunks without the data outside GTIs
+    def run_ligthcurve(self, gtis):
+        return lcHelper.LigthcurveChunks(consts.LC_FILE, consts.STREAM_CHUNK_SIZE, gtis)
+
+    # Loads the attitude data
+    def run_attitude(self):
+        return self.load_file(attHelper.load_attitude, consts.ATT_FILE)
+
+    # Returns the values projected for each observation and their Poisson
+    # variances, one column per channel, and the mask of the observations used
+    def get_values(self, lc):
+
+        if self.mode == "energy":
+            return lc.energies, lc.energies_variances, np.ones(len(lc), dtype=bool)
+
+        total_counts = lc.total_counts
+        valid = (total_counts >= consts.MIN_COUNTS) & (total_counts != 0)
+        return lc.corrected_counts[valid], lc.corrected_counts_variances[valid], valid
+
+    # Returns the hash of the constants.py values the binned data depends on,
+    # the checkpoints with other hash are not used
+    def get_checkpoint_hash(self):
+        names = [ name for stage in [ "ligthcurve", "attitude", "projection" ]
+                  for name in STAGE_PARAMS[stage] if name != "STREAM_CHUNK_SIZE" ]
+        values = [ self.mode ] + [ repr(getattr(consts, name)) for name in names ]
+        return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()
+
+    # Returns the accumulator of the CHECKPOINT_FILE if it exists and has the same
+    # configuration, else a new one. The accumulator bins the values of each channel
+    # followed by their variances
+    def get_accumulator(self, config_hash):
+
+        channels = 2 * consts.LC_NUM_CHANNELS
+
+        accumulator = skyAcc.load(consts.CHECKPOINT_FILE, config_hash)
+        if accumulator is not None and accumulator.channels == channels:
+            print ("- Resuming from checkpoint with " + str(accumulator.samples) + " samples.")
+            return accumulator
+
+        return skyAcc.SkyAccumulator(channels,
+                                     backend=consts.PROJECTION_BACKEND,
+                                     nside=consts.HEALPIX_NSIDE,
+                                     method=consts.PROJECTION_METHOD)
+
+    # Projects all the observations over the energy (or counts) cube, with
+    # one map per channel, the cube of their variances and the exposure map.
+    # The chunks are binned one by one and the MRSC is applied once at the end
+    def run_projection(self, lc_chunks, att):
+
+        print ("- Input data is ready.")
+
+        config_hash = self.get_checkpoint_hash()
+        accumulator = self.get_accumulator(config_hash)
+        uncovered = 0
+
+        for chunk_idx, (lc, signs, end_time) in enumerate(lc_chunks.iter_changes(accumulator.is_projected)):
+
+            for sign in [ 1, -1 ]:
+                lc_rows = lcHelper.Ligthcurve(lc.data[signs == sign])
+                if len(lc_rows):
+                    values, variances, valid = self.get_values(lc_rows)
+                    times = lc_rows.times[valid]
+
+                    # The samples without attitude are not projected
+                    covered = attHelper.get_coverage_mask(times, att)
+                    if sign > 0:
+                        uncovered += len(covered) - np.count_nonzero(covered)
+
+                    ras, decs = attHelper.get_ra_dec_array(times[covered], att)
+                    accumulator.add(ras, decs, np.column_stack((values[covered], variances[covered])), sign)
+
+            accumulator.set_projected(end_time, lc_chunks.gtis)
+
+            if consts.CHECKPOINT_FILE is not None and (chunk_idx + 1) % consts.CHECKPOINT_INTERVAL == 0:
+                accumulator.save(consts.CHECKPOINT_FILE, config_hash)
+
+        if consts.CHECKPOINT_FILE is not None:
+            accumulator.save(consts.CHECKPOINT_FILE, config_hash)
+
+        attHelper.warn_uncovered(uncovered)
+
+        cube, exposure_map = accumulator.get_maps()
+
+        print ("- " + self.mode.capitalize() + " and exposure data ready, preparing flux map.")
+
+        channels = accumulator.channels // 2
+        return { "cube": cube[:channels], "variance": cube[channels:], "exposure": exposure_map,
+                 "samples": accumulator.samples }
+
+    # Returns a map as a RA/Dec grid, converting it if it is a HEALPix vector
+    def get_car_map(self, data):
+
+        if data.ndim == 1:
+            return hpMapHelper.healpix_to_car(data, consts.IMG_SCALE)
+
+        return data
+
+    # Returns the sum of the maps of the given channels (all if None) of a cube of
+    # the projection: "cube" or "variance"
+    def get_band_map(self, channels=None, name="cube"):
+
+        cube = self.get("projection")[name]
+        if channels is None:
+            return np.sum(cube, axis=0)
+
+        return np.sum(cube[list(channels)], axis=0)
+
+    # Sums the cube and variance maps of the LC_BAND_CHANNELS
+    def run_band(self, projection):
+
+        return { "values": self.get_band_map(consts.LC_BAND_CHANNELS),
+                 "variance": self.get_band_map(consts.LC_BAND_CHANNELS, "variance"),
+                 "exposure": projection["exposure"] }
+
+    # Calculates the flux map and calibrates it in range 0..COLORS
+    def run_finalize(self, band):
+
+        flux_map = imgHelper.getFluxMap(band["values"], band["exposure"],
+                                        consts.MIN_EXPOSURE)
+
+        method = "max" if self.mode == "energy" else "minmax"
+        calibrated_map = imgHelper.calibrateMap(flux_map, method, consts.COLORS)
+
+        return { "flux": flux_map, "calibrated": calibrated_map }
+
+    # Equalizes the calibrated flux map if EQUALIZE_IMAGE is set
+    def run_equalize(self, finalized):
+
+        if consts.EQUALIZE_IMAGE:
+            return hist.stretch(finalized["calibrated"], consts.STRETCH)
+
+        return finalized["calibrated"]
+
+    # Splits the final image and saves it as Fits files if WRITE_FITS_FILES is set,
+    # returns the manifest of the saved files
+    def run_export(self, img):
+
+        if consts.WRITE_FITS_FILES:
+            return imgHelper.saveTiles(self.get_car_map(img), consts.OUTPUT_FOLDER,
+                                       workers=consts.EXPORT_WORKERS)
+
+        return []
+
+    # Writes the final image as a HiPS if WRITE_HIPS is set, the pixels with
+    # exposure not above MIN_EXPOSURE are left without coverage
+    def run_hips(self, img, band):
+
+        if consts.WRITE_HIPS:
+            return hipsHelper.save_hips(img, consts.HIPS_FOLDER,
+                                        coverage=band["exposure"] > consts.MIN_EXPOSURE,
+                                        order=consts.HIPS_ORDER,
+                                        tile_width=consts.HIPS_TILE_WIDTH,
+                                        formats=consts.HIPS_FORMATS,
+                                        title=consts.HIPS_TITLE,
+                                        workers=consts.EXPORT_WORKERS)
+
+        return {}
+
+    # Measures the band maps at the positions of the sources of the CATALOG_FILE and
+    # saves the table in PHOTOMETRY_FILE if it is set. Returns the catalogue and the
+    # value, exposure and error of each source (see photometry_helper)
+    def run_photometry(self, band):
+
+        catalog = srcHelper.load_catalog(consts.CATALOG_FILE)
+        photometry = photHelper.forced_photometry(band["values"], band["variance"], band["exposure"],
+                                                  catalog["ra"], catalog["dec"],
+                                                  method=consts.PHOTOMETRY_METHOD,
+                                                  min_exposure=consts.MIN_EXPOSURE)
+
+        if consts.PHOTOMETRY_FILE is not None:
+            photHelper.save_photometry(consts.PHOTOMETRY_FILE, catalog, photometry)
+            print('Saved photometry of ' + str(len(catalog)) + ' sources in: ' + consts.PHOTOMETRY_FILE)
+
+        photometry["catalog"] = catalog
+        return photometry
+
+    # Shows the exposure, energy (or counts), flux and equalized maps
+    def show_plots(self):
+        import matplotlib.pyplot as plt
+
+        band = self.get("band")
+        finalized = self.get("finalize")
+        catalog = srcHelper.load_catalog(consts.CATALOG_FILE)
+
+        plots = [ ("Exposure Map", band["exposure"], True),
+                  (self.mode.capitalize() + " Map", band["values"], False),
+                  ("All Sky Plot", finalized["calibrated"], False) ]
+
+        if consts.EQUALIZE_IMAGE:
+            plots.append(("All Sky Equalized Plot", self.get("equalize"), True))
+
+        for title, data, annotate in plots:
+            plt.title(title)
+            plt.imshow(self.get_car_map(data))
+            plt.colorbar()
+            if annotate:
+                for source in catalog:
+                    plt.annotate(source["name"], xy=(source["ra"] * consts.IMG_SCALE,
+                                                     (source["dec"] + 90) * consts.IMG_SCALE),
+                                 xycoords='data', xytext=(10, 10), textcoords='offset points',
+                                 arrowprops=dict(arrowstyle="->"))
+            plt.show()
@@ -1,14 +1,20 @@
 
 import numpy as np
+from utils import cache_helper as cacheHelper
 import constants as consts
 
-def load_attitude (filePath):
+def parse_attitude (filePath, header_rows, time_col, ra_col, dec_col):
     return np.loadtxt(filePath,
                     comments="#",
                     delimiter=",",
-                    skiprows=consts.ATT_HEADER_ROWS,
-                    converters = {consts.ATT_RA_COL: lambda s: 360.0 * (float(s.strip() or 0) / 24.0)},  #Convert hours to degrees
-                    usecols = (consts.ATT_TIME_COL, consts.ATT_RA_COL, consts.ATT_DEC_COL))
+                    skiprows=header_rows,
+                    converters = {ra_col: lambda s: 360.0 * (float(s.strip() or 0) / 24.0)},  #Convert hours to degrees
+                    usecols = (time_col, ra_col, dec_col))
+
+# Loads the attitude file, parsing it only the first time (see cache_helper)
+def load_attitude (filePath):
+    return cacheHelper.load_cached(parse_attitude, filePath, consts.ATT_HEADER_ROWS,
+                                   consts.ATT_TIME_COL, consts.ATT_RA_COL, consts.ATT_DEC_COL)
 
 
 # Returns the ra dec interpolated for a given time
@@ -58,3 +64,54 @@ def get_ra_dec(time, att):
 
     #print(str([ ra, dec, f_time ]) + " - " + str(tmp_time) + " ... " + str(att[idx, 0]))
     return [ ra, dec ]
+
+
+# Returns the mask of the times inside the time range of the attitude rows
+def get_coverage_mask(times, att):
+    times = np.asarray(times, dtype=float)
+    return (times >= att[0, 0]) & (times <= att[-1, 0])
+
+
+# Prints a warning with the number of samples outside the time range of the
+# attitude rows, if any
+def warn_uncovered(count):
+    if count > 0:
+        print("Warning: " + str(count) + " samples outside the time range of the attitude file were dismissed.")
+
+
+# Returns the ra and dec arrays interpolated for the given times array.
+# Times before the first or after the last attitude row get NaN coordinates,
+# they can be dismissed with get_coverage_mask. If wrap_ra is True the RA is
+# interpolated through the shortest path, so 359 to 1 degrees passes by 0 instead of 180.
+def get_ra_dec_array(times, att, wrap_ra=True):
+
+    times = np.asarray(times, dtype=float)
+    att_times = att[:, 0]
+
+    if len(att_times) < 2:
+        covered = get_coverage_mask(times, att)
+        return np.where(covered, att[0, 1], np.nan), np.where(covered, att[0, 2], np.nan)
+
+    idx = np.searchsorted(att_times, times, side="right") - 1
+    idx = np.clip(idx, 0, len(att_times) - 2)
+
+    t_inc = att_times[idx + 1] - att_times[idx]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(t_inc > 0, (times - att_times[idx]) / t_inc, 0.0)
+    ratio = np.clip(ratio, 0.0, 1.0)
+
+    ra_inc = att[idx + 1, 1] - att[idx, 1]
+    if wrap_ra:
+        ra_inc = ((ra_inc + 180.0) % 360.0) - 180.0
+
+    ra = att[idx, 1] + (ra_inc * ratio)
+    if wrap_ra:
+        ra = ra % 360.0
+
+    dec = att[idx, 2] + ((att[idx + 1, 2] - att[idx, 2]) * ratio)
+
+    uncovered = ~get_coverage_mask(times, att)
+    ra[uncovered] = np.nan
+    dec[uncovered] = np.nan
+
+    return ra, dec
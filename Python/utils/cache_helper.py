@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Cached loading of the text data files.
+# The array parsed from a file is saved as .npy in CACHE_FOLDER, and the next
+# loads of the same file with the same parse function and options memory-map
+# it (read only) instead of parsing the text again. The cache is shared by all
+# the scripts and processes.
+#
+# Cache file name: {file name}_{hash of path}_{hash of mtime and size}_{hash of parse options}.npy
+# The parse options include the bytecode of the parse function and CACHE_VERSION,
+# increase it when the parsed arrays change without changes in that bytecode
+# (ex: a column schema or a function called by the parse function).
+# When a file changes its old cache files are removed.
+# Set CACHE_FOLDER to None for disabling the cache.
+#
+# The outputs of the AllSkyPipeline stages are cached too in STAGE_CACHE_FOLDER,
+# pickled in files named by the stage and its signature: {stage}_{signature}.pkl.
+# The least recently used ones are removed when the folder is larger than
+# STAGE_CACHE_MAX_SIZE bytes.
+
+import os
+import glob
+import hashlib
+import pickle
+import tempfile
+import numpy as np
+import constants as consts
+
+# Version of the cached arrays, the cache files of other versions are not used
+CACHE_VERSION = 1
+
+
+def get_hash(value):
+    return hashlib.sha1(repr(value).encode("utf-8")).hexdigest()[:12]
+
+
+# Returns the modification time and size of a file, None if it doesn't exist
+def get_file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+# Returns the cache file path of a data file parsed with the given function and options
+def get_cache_path(path, parse, args, kwargs):
+
+    state = get_file_state(path)
+    if state is None:
+        raise IOError("File not found: " + str(path))
+
+    path_hash = get_hash(os.path.abspath(path))
+    state_hash = get_hash(state)
+    code = getattr(parse, "__code__", None)
+    options_hash = get_hash((CACHE_VERSION, parse.__module__, parse.__name__,
+                             code.co_code if code is not None else None,
+                             args, sorted(kwargs.items())))
+
+    name = os.path.basename(path).replace(" ", "_")
+    return os.path.join(consts.CACHE_FOLDER, name + "_" + path_hash + "_" + state_hash + "_" + options_hash + ".npy")
+
+
+# Removes the cache files of older versions of a data file
+def remove_stale(cache_path):
+
+    prefix, state_hash, options_hash = cache_path[:-4].rsplit("_", 2)
+    for old_path in glob.glob(glob.escape(prefix) + "_*_*.npy"):
+        if old_path[:-4].rsplit("_", 2)[1] != state_hash:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+# Creates the folder if doesn't exist, also if other process creates it at the
+# same time. An empty folder is the current folder
+def make_folder(folder):
+    if folder and not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+
+
+# Saves the data with the given save function, writing a temporary file in the
+# same folder first and replacing the file with it, so other processes never
+# read a partial file and an interrupted save keeps the previous file
+def save_file(path, data, save=np.save):
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            save(tmp_file, data)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+# Returns parse(path, *args, **kwargs), from the cache if the file was already parsed.
+# The options must have a stable repr (no lambdas), since they are part of the key.
+def load_cached(parse, path, *args, **kwargs):
+
+    if consts.CACHE_FOLDER is None:
+        return parse(path, *args, **kwargs)
+
+    cache_path = get_cache_path(path, parse, args, kwargs)
+    if os.path.isfile(cache_path):
+        return np.load(cache_path, mmap_mode="r")
+
+    data = np.asarray(parse(path, *args, **kwargs))
+
+    make_folder(consts.CACHE_FOLDER)
+    remove_stale(cache_path)
+    save_file(cache_path, data)
+
+    return data
+
+
+# Cached np.loadtxt
+def loadtxt(path, **kwargs):
+    return load_cached(np.loadtxt, path, **kwargs)
+
+
+def get_stage_path(stage, signature):
+    return os.path.join(consts.STAGE_CACHE_FOLDER, stage + "_" + signature + ".pkl")
+
+
+# Returns the cached output of a stage with the given signature, None if it isn't cached
+def load_stage(stage, signature):
+
+    if consts.STAGE_CACHE_FOLDER is None:
+        return None
+
+    stage_path = get_stage_path(stage, signature)
+    try:
+        with open(stage_path, "rb") as stage_file:
+            data = pickle.load(stage_file)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+    # Marks it as recently used
+    try:
+        os.utime(stage_path, None)
+    except OSError:
+        pass
+
+    return data
+
+
+# Saves the output of a stage with the given signature and removes the least
+# recently used outputs if the cache is larger than STAGE_CACHE_MAX_SIZE
+def save_stage(stage, signature, data):
+
+    if consts.STAGE_CACHE_FOLDER is None:
+        return
+
+    make_folder(consts.STAGE_CACHE_FOLDER)
+    save_file(get_stage_path(stage, signature), data,
+              save=lambda stage_file, data: pickle.dump(data, stage_file, pickle.HIGHEST_PROTOCOL))
+
+    evict_stages(consts.STAGE_CACHE_MAX_SIZE)
+
+
+# Removes the least recently used stage outputs until the cache size is not above max_size
+def evict_stages(max_size):
+
+    entries = []
+    for stage_path in glob.glob(os.path.join(glob.escape(consts.STAGE_CACHE_FOLDER), "*.pkl")):
+        state = get_file_state(stage_path)
+        if state is not None:
+            entries.append((state[0], state[1], stage_path))
+
+    total_size = sum(entry[1] for entry in entries)
+    for mtime, size, stage_path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(stage_path)
+            total_size -= size
+        except OSError:
+            pass
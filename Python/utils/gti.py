@@ -101,79 +101,19 @@ def cross_two_gtis(gti0, gti1):
     >>> np.all(newgti == [[1, 4]])
     True
     """
-    gti0 = join_equal_gti_boundaries(np.asarray(gti0))
-    gti1 = join_equal_gti_boundaries(np.asarray(gti1))
-    # Check GTIs
-    check_gtis(gti0)
-    check_gtis(gti1)
-
-    gti0_start = gti0[:, 0]
-    gti0_end = gti0[:, 1]
-    gti1_start = gti1[:, 0]
-    gti1_end = gti1[:, 1]
-
-    # Create a list that references to the two start and end series
-    gti_start = [gti0_start, gti1_start]
-    gti_end = [gti0_end, gti1_end]
-
-    # Concatenate the series, while keeping track of the correct origin of
-    # each start and end time
-    gti0_tag = np.array([0 for g in gti0_start], dtype=bool)
-    gti1_tag = np.array([1 for g in gti1_start], dtype=bool)
-    conc_start = np.concatenate((gti0_start, gti1_start))
-    conc_end = np.concatenate((gti0_end, gti1_end))
-    conc_tag = np.concatenate((gti0_tag, gti1_tag))
-
-    # Put in time order
-    order = np.argsort(conc_end)
-    conc_start = conc_start[order]
-    conc_end = conc_end[order]
-    conc_tag = conc_tag[order]
-
-    last_end = conc_start[0] - 1
-    final_gti = []
-    for ie, e in enumerate(conc_end):
-        # Is this ending in series 0 or 1?
-        this_series = conc_tag[ie]
-        other_series = not this_series
-
-        # Check that this closes intervals in both series.
-        # 1. Check that there is an opening in both series 0 and 1 lower than e
-        try:
-            st_pos = \
-                np.argmax(gti_start[this_series][gti_start[this_series] < e])
-            so_pos = \
-                np.argmax(gti_start[other_series][gti_start[other_series] < e])
-            st = gti_start[this_series][st_pos]
-            so = gti_start[other_series][so_pos]
-
-            s = np.max([st, so])
-        except:  # pragma: no cover
-            continue
-
-        # If this start is inside the last interval (It can happen for equal
-        # GTI start times between the two series), then skip!
-        if s <= last_end:
-            continue
-        # 2. Check that there is no closing before e in the "other series",
-        # from intervals starting either after s, or starting and ending
-        # between the last closed interval and this one
-        cond1 = (gti_end[other_series] > s) * (gti_end[other_series] < e)
-        cond2 = gti_end[other_series][so_pos] < s
-        condition = np.any(np.logical_or(cond1, cond2))
-        # Well, if none of the conditions at point 2 apply, then you can
-        # create the new gti!
-        if not condition:
-            final_gti.append([s, e])
-            last_end = e
-
-    return np.array(final_gti)
+    return cross_gtis([gti0, gti1])
 
 
 def cross_gtis(gti_list):
     """
     From multiple GTI lists, extract the common intervals *EXACTLY*.
 
+    All the GTI boundaries are merged in a single sorted sweep line, where
+    each start opens and each end closes one interval. A common interval
+    starts when all the lists are open and ends when the first of them
+    closes. At equal times starts are processed before ends, so touching
+    GTIs of the same list are joined, and zero-length intervals are removed.
+
     Parameters
     ----------
     gti_list : array-like
@@ -188,21 +128,50 @@ def cross_gtis(gti_list):
     See Also
     --------
     cross_two_gtis : Extract the common intervals from two GTI lists *EXACTLY*
-    """
-    gti_list = np.asarray(gti_list)
-    for g in gti_list:
-        check_gtis(g)
 
+    Examples
+    --------
+    >>> gti1 = np.array([[1, 3], [5, 9]])
+    >>> gti2 = np.array([[2, 6], [8, 10]])
+    >>> gti3 = np.array([[0, 10]])
+    >>> newgti = cross_gtis([gti1, gti2, gti3])
+    >>> np.all(newgti == [[2, 3], [5, 6], [8, 9]])
+    True
+    >>> gti1 = np.array([[1, 2]])
+    >>> gti2 = np.array([[2, 3]])
+    >>> len(cross_gtis([gti1, gti2]))
+    0
+    """
+    gti_list = [np.asarray(g) for g in gti_list]
     ninst = len(gti_list)
     if ninst == 1:
+        check_gtis(gti_list[0])
         return gti_list[0]
 
-    gti0 = gti_list[0]
+    if any(len(g) == 0 for g in gti_list):
+        return np.zeros((0, 2))
+
+    for g in gti_list:
+        check_gtis(g)
+
+    starts = np.concatenate([g[:, 0] for g in gti_list])
+    ends = np.concatenate([g[:, 1] for g in gti_list])
+
+    times = np.concatenate((starts, ends))
+    steps = np.concatenate((np.ones(len(starts), dtype=int),
+                            -np.ones(len(ends), dtype=int)))
+
+    # Put in time order, starts before ends at equal times
+    order = np.lexsort((-steps, times))
+    times = times[order]
+    steps = steps[order]
+    n_open = np.cumsum(steps)
 
-    for gti in gti_list[1:]:
-        gti0 = cross_two_gtis(gti0, gti)
+    opening = (steps == 1) & (n_open == ninst)
+    closing = (steps == -1) & (n_open == ninst - 1)
 
-    return gti0
+    final_gti = np.column_stack((times[opening], times[closing]))
+    return final_gti[final_gti[:, 1] > final_gti[:, 0]]
 
 
 def get_btis(gtis, start_time=None, stop_time=None):
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# HEALPix functions for the NESTED scheme, vectorized with numpy.
+# Based on the HEALPix C++ library, Gorski et al. (2005), ApJ, 622, 759
+# Coordinates are RA and Dec in degrees.
+
+import numpy as np
+
+# Ring and longitude index of the corners of the twelve base pixels
+JRLL = np.array([ 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4 ])
+JPLL = np.array([ 1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7 ])
+
+
+def order2nside(order):
+    return 1 << order
+
+
+def nside2order(nside):
+    order = int(np.log2(nside))
+    if (1 << order) != nside:
+        raise ValueError("nside must be a power of 2: " + str(nside))
+    return order
+
+
+def nside2npix(nside):
+    return 12 * nside * nside
+
+
+# Mean angular size of a pixel in degrees
+def nside2resol(nside):
+    return np.degrees(np.sqrt(4.0 * np.pi / nside2npix(nside)))
+
+
+# Returns the lowest order with pixels smaller than the pixels of a map of
+# the given scale (pixels by degree)
+def scale2order(scale):
+    return max(0, int(np.ceil(np.log2(nside2resol(1) * scale))))
+
+
+# Interleaves the bits of v with zeros: b2 b1 b0 -> 0 b2 0 b1 0 b0
+def spread_bits(v):
+    v = np.asarray(v, dtype=np.int64) & 0xFFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+# Inverse of spread_bits, takes the even bits of v
+def compress_bits(v):
+    v = np.asarray(v, dtype=np.int64) & 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    v = (v | (v >> 16)) & 0x00000000FFFFFFFF
+    return v
+
+
+# Returns the x, y coordinates inside the base pixel and the base pixel (face)
+def nest2xyf(nside, pix):
+    order = nside2order(nside)
+    pix = np.asarray(pix, dtype=np.int64)
+    face = pix >> (2 * order)
+    pix = pix & ((1 << (2 * order)) - 1)
+    return compress_bits(pix), compress_bits(pix >> 1), face
+
+
+def xyf2nest(nside, ix, iy, face):
+    order = nside2order(nside)
+    return (np.asarray(face, dtype=np.int64) << (2 * order)) + spread_bits(ix) + (spread_bits(iy) << 1)
+
+
+# Returns the RA and Dec of the centers of the pixels
+def pix2ang(nside, pix):
+
+    ix, iy, face = nest2xyf(nside, pix)
+    npix = nside2npix(nside)
+    fact2 = 4.0 / npix
+    fact1 = (nside << 1) * fact2
+
+    jr = (JRLL[face] * nside) - ix - iy - 1
+
+    north = jr < nside
+    south = jr > 3 * nside
+
+    nr = np.where(north, jr, np.where(south, 4 * nside - jr, nside))
+    z = np.where(north, 1.0 - nr * nr * fact2,
+                 np.where(south, nr * nr * fact2 - 1.0, (2 * nside - jr) * fact1))
+    kshift = np.where(north | south, 0, (jr - nside) & 1)
+
+    jp = (JPLL[face] * nr + ix - iy + 1 + kshift) // 2
+    jp = np.where(jp > 4 * nside, jp - 4 * nside, jp)
+    jp = np.where(jp < 1, jp + 4 * nside, jp)
+
+    phi = (jp - (kshift + 1) * 0.5) * (0.5 * np.pi / nr)
+
+    return np.degrees(phi) % 360.0, np.degrees(np.arcsin(np.clip(z, -1.0, 1.0)))
+
+
+# Returns the pixels that contain the given coordinates
+def ang2pix(nside, ra, dec):
+
+    z = np.sin(np.radians(np.asarray(dec, dtype=float)))
+    tt = (np.asarray(ra, dtype=float) % 360.0) / 90.0  # in [0,4)
+    za = np.abs(z)
+
+    # Equatorial region
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * (z * 0.75)
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp = jp // nside
+    ifm = jm // nside
+    face_eq = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix_eq = jm & (nside - 1)
+    iy_eq = nside - (jp & (nside - 1)) - 1
+
+    # Polar caps
+    ntt = np.minimum(3, tt.astype(np.int64))
+    tp = tt - ntt
+    tmp = nside * np.sqrt(3.0 * (1.0 - za))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1.0 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+    face_pol = np.where(north, ntt, ntt + 8)
+    ix_pol = np.where(north, nside - jm - 1, jp)
+    iy_pol = np.where(north, nside - jp - 1, jm)
+
+    equatorial = za <= 2.0 / 3.0
+    face = np.where(equatorial, face_eq, face_pol)
+    ix = np.where(equatorial, ix_eq, ix_pol)
+    iy = np.where(equatorial, iy_eq, iy_pol)
+
+    return xyf2nest(nside, ix, iy, face)
+
+
+def npix2nside(npix):
+    nside = int(np.sqrt(npix / 12))
+    if nside2npix(nside) != npix:
+        raise ValueError("Wrong number of pixels: " + str(npix))
+    return nside
+
+
+# Returns the unit vectors of the coordinates, shape (..., 3)
+def ang2vec(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.stack([ cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec) ], axis=-1)
+
+
+# Returns the unit vectors of the centers of all the pixels
+def pix2vec_all(nside):
+    ras, decs = pix2ang(nside, np.arange(nside2npix(nside)))
+    return ang2vec(ras, decs)
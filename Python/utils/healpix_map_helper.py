@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# HEALPIX MAPS
+# ===============================================
+# Projects the observations over all sky maps in the HEALPix NESTED scheme,
+# as an alternative to the CAR maps of img_helper. The pixels have the same
+# area everywhere, so the poles are not oversampled.
+#
+# Each observation is located in the pixel that contains its pointing, and the
+# MRSC is projected around the center of that pixel. The MRSC value of a sky
+# pixel is looked up from its angular offsets to the pointing along the local
+# East and North directions, so the footprint is not distorted at high |Dec|
+# as the RA offsets of the CAR maps are.
+#
+# The candidate pixels of each footprint are found with a disc lookup on a
+# coarser order, whose pixels contain consecutive ranges of pixels of the
+# map order in the NESTED scheme.
+
+import numpy as np
+import scipy.sparse
+from utils import healpix_helper as hpHelper
+import constants as consts
+
+# Max number of candidate pixels of the footprints computed at once
+FOOTPRINT_CHUNK_SIZE = 1 << 22
+
+# Unit vectors of the pixels of each nside, computed the first time are needed
+PIXEL_VECTORS = {}
+
+
+# Returns the lowest nside with pixels smaller than the pixels of a CAR map of
+# the given scale (pixels by degree)
+def get_nside(scale):
+    return hpHelper.order2nside(hpHelper.scale2order(scale))
+
+
+def get_pixel_vectors(nside):
+    if nside not in PIXEL_VECTORS:
+        PIXEL_VECTORS[nside] = hpHelper.pix2vec_all(nside)
+    return PIXEL_VECTORS[nside]
+
+
+# Returns the center, East and North unit vectors at the given coordinates
+def get_local_axes(ras, decs):
+    centers = hpHelper.ang2vec(ras, decs)
+
+    ras = np.radians(ras)
+    decs = np.radians(decs)
+    east = np.stack([ -np.sin(ras), np.cos(ras), np.zeros(len(ras)) ], axis=-1)
+    north = np.stack([ -np.sin(decs) * np.cos(ras), -np.sin(decs) * np.sin(ras), np.cos(decs) ], axis=-1)
+
+    return centers, east, north
+
+
+# Returns the center, East and North axes of each pointing (pointings x 3 x 3), as
+# the columns of a rotation matrix. The coordinates of a unit vector v along the
+# axes of a pointing are: np.dot(v, axes[pointing])
+def get_pointing_axes(ras, decs):
+    return np.stack(get_local_axes(np.asarray(ras, dtype=float), np.asarray(decs, dtype=float)), axis=2)
+
+
+# Returns the MRSC ratios of the points with the given coordinates (... x 3) along
+# the center, East and North axes of a pointing. The MRSC element of a point is
+# the one of its angular offsets to the pointing along the East and North
+# directions, zero outside the kernel. kernel has the MRSC ratios, with cell
+# degrees per element
+def get_kernel_ratios(local_coords, kernel, cell):
+
+    kernel_size = kernel.shape[0]
+    kernel_center = kernel_size // 2
+    rad_to_cell = float(np.degrees(1.0) / cell)  # Python float, keeps the dtype of local_coords
+
+    cols = np.rint(np.arctan2(local_coords[..., 1], local_coords[..., 0]) * rad_to_cell).astype(np.int32)
+    rows = np.rint(np.arctan2(local_coords[..., 2], local_coords[..., 0]) * rad_to_cell).astype(np.int32)
+
+    # Kernel with a border of zeros, the offsets outside the kernel are clipped to the border
+    np.clip(cols + (kernel_center + 1), 0, kernel_size + 1, out=cols)
+    np.clip(rows + (kernel_center + 1), 0, kernel_size + 1, out=rows)
+    padded_kernel = np.pad(kernel, 1, mode="constant").ravel()
+
+    return padded_kernel.take(rows * (kernel_size + 2) + cols)
+
+
+# Returns the coordinates (... x 3, not normalized) along the center, East and North
+# axes of a pointing of the points with the given angular offsets (degrees) along
+# the North and East directions, the inverse of the lookup of get_kernel_ratios
+def get_kernel_coords(row_offsets, col_offsets):
+
+    tan_x = np.tan(np.radians(col_offsets))
+    tan_y = np.tan(np.radians(row_offsets))
+    return np.stack([ np.ones(tan_x.shape), tan_x, tan_y ], axis=-1)
+
+
+# Returns the coarse order used for finding the candidate pixels of a disc of
+# the given radius (degrees), with pixels about 1/16 of the radius
+def get_coarse_order(order, radius):
+    coarse_order = int(np.ceil(np.log2(hpHelper.nside2resol(1) * 16.0 / radius)))
+    return min(order, max(0, coarse_order))
+
+
+# Returns the cosine of the angular radius of the disc containing the non zero
+# elements of the kernel, with cell degrees per element
+def get_kernel_cos_radius(kernel, cell):
+
+    rows, cols = np.nonzero(kernel)
+    kernel_center = kernel.shape[0] // 2
+
+    # The farthest point of an element is its outer corner
+    tan_x = np.tan(np.radians(np.minimum((np.abs(cols - kernel_center) + 0.5) * cell, 90.0)))
+    tan_y = np.tan(np.radians(np.minimum((np.abs(rows - kernel_center) + 0.5) * cell, 90.0)))
+    return np.min(1.0 / np.sqrt(1.0 + tan_x ** 2 + tan_y ** 2))
+
+
+# Returns the pointing indices and pixels of the coarse pixels closer than radius
+# (degrees) to the given unit vectors
+def get_coarse_discs(coarse_nside, centers, radius):
+
+    coarse_vectors = get_pixel_vectors(coarse_nside)
+
+    # Max distance from the center of a pixel to its corners is below 1.5 times its size
+    max_dist = np.radians(radius + 1.5 * hpHelper.nside2resol(coarse_nside))
+    pointing_idx, coarse_pixels = np.nonzero(np.dot(centers, coarse_vectors.T) >= np.cos(min(max_dist, np.pi)))
+
+    return pointing_idx, coarse_pixels
+
+
+# Returns the pointing indices, pixels and MRSC ratios of the footprints of the MRSC
+# centered on the given pixels. kernel is the MRSC of width fov (degrees).
+# The footprints are returned in chunks of about FOOTPRINT_CHUNK_SIZE candidate pixels
+def get_footprints(nside, pointing_pixels, kernel=None, fov=None):
+
+    kernel = np.asarray(consts.MRSC if kernel is None else kernel, dtype=float) / 100.0
+    fov = consts.FOV if fov is None else fov
+    cell = float(fov) / kernel.shape[0]  # Degrees per MRSC element
+
+    radius = np.degrees(np.arccos(get_kernel_cos_radius(kernel, cell)))
+
+    order = hpHelper.nside2order(nside)
+    coarse_order = get_coarse_order(order, radius)
+    coarse_nside = hpHelper.order2nside(coarse_order)
+    children = 4 ** (order - coarse_order)  # Pixels of the map order in a coarse pixel
+
+    # Unit vectors of the pixels of the map order grouped by coarse pixel
+    blocks = get_pixel_vectors(nside).reshape(-1, children, 3).astype(np.float32)
+
+    # Pointings by chunk from the number of candidate pixels of one pointing
+    disc_pixels = (2.0 * np.pi * (1.0 - np.cos(np.radians(radius + 1.5 * hpHelper.nside2resol(coarse_nside))))
+                   / (4.0 * np.pi / hpHelper.nside2npix(nside)))
+    chunk_size = max(1, int(FOOTPRINT_CHUNK_SIZE / disc_pixels))
+
+    axes = get_pointing_axes(*hpHelper.pix2ang(nside, pointing_pixels))
+
+    for start in range(0, len(pointing_pixels), chunk_size):
+        end = min(start + chunk_size, len(pointing_pixels))
+
+        pointing_idx, coarse_pixels = get_coarse_discs(coarse_nside, axes[start:end, :, 0], radius)
+
+        # Coordinates of the candidate pixels along the axes of their pointing
+        local = np.matmul(blocks[coarse_pixels], axes[start:end][pointing_idx].astype(np.float32))
+
+        ratios = get_kernel_ratios(local, kernel, cell)
+        pair_idx, child_idx = np.nonzero(ratios > 0)
+
+        pixels = coarse_pixels[pair_idx] * children + child_idx
+        yield pointing_idx[pair_idx] + start, pixels, ratios[pair_idx, child_idx]
+
+
+# Returns the sum of values of each channel (channels x npix) and the number of
+# observations on each pixel of a HEALPix map. Values has one column per channel.
+def binObservationsHealpix(ras, decs, values, nside):
+
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+
+    npix = hpHelper.nside2npix(nside)
+    pixels = hpHelper.ang2pix(nside, ras, decs)
+
+    values_bins = np.zeros((values.shape[1], npix))
+    for channel in range(values.shape[1]):
+        values_bins[channel] = np.bincount(pixels, weights=values[:, channel], minlength=npix)
+
+    counts_bins = np.bincount(pixels, minlength=npix).astype(float)
+
+    return values_bins, counts_bins
+
+
+# Projects the MRSC centered on each pixel with observations, weighted by the binned
+# values (channels x npix) and counts of the pixel. Returns the cube and the exposure map
+def convolveFootprints(values_bins, counts_bins, kernel=None, fov=None):
+
+    npix = len(counts_bins)
+    nside = hpHelper.npix2nside(npix)
+
+    pointing_pixels = np.nonzero(counts_bins)[0]
+    binned_values = values_bins[:, pointing_pixels].T
+    binned_counts = counts_bins[pointing_pixels]
+
+    cube = np.zeros(values_bins.shape)
+    exposure_map = np.zeros(npix)
+
+    for pointing_idx, pixels, ratios in get_footprints(nside, pointing_pixels, kernel, fov):
+        footprints = scipy.sparse.csr_matrix((ratios, (pixels, pointing_idx)),
+                                             shape=(npix, len(pointing_pixels)))
+        cube += (footprints * binned_values).T
+        exposure_map += footprints * binned_counts
+
+    return cube, exposure_map
+
+
+# Projects the values of the observations (one column per channel) over a cube of
+# HEALPix maps (channels x npix) and an exposure map at the given nside.
+# Returns the cube and the exposure map
+def drawFOVsHealpix(ras, decs, values, nside, kernel=None, fov=None):
+
+    values_bins, counts_bins = binObservationsHealpix(ras, decs, values, nside)
+    return convolveFootprints(values_bins, counts_bins, kernel, fov)
+
+
+# Samples a HEALPix map (or a cube of maps, with the pixels in the last axis)
+# at the centers of the pixels of a CAR map of the given scale (pixels by degree)
+def healpix_to_car(hp_map, scale):
+
+    hp_map = np.asarray(hp_map)
+    nside = hpHelper.npix2nside(hp_map.shape[-1])
+
+    height = int(180.0 * scale)
+    width = int(360.0 * scale)
+    decs = (np.arange(height) + 0.5) / scale - 90.0
+    ras = (np.arange(width) + 0.5) / scale
+
+    pixels = hpHelper.ang2pix(nside, ras[np.newaxis, :], decs[:, np.newaxis])
+    return hp_map[..., pixels]
@@ -0,0 +1,296 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# HiPS WRITER
+# ===============================================
+# Writes an all sky image in CAR projection or a HEALPix NESTED map (as the ones
+# generated with the AllSkyPipeline) as a HiPS (Hierarchical Progressive Survey):
+# http://www.ivoa.net/documents/HiPS/
+#
+# The pixels of the tiles of the deepest order are sampled from the all sky image
+# in the HEALPix NESTED scheme, and the tiles of the lower orders are built by
+# averaging the pixels of their four children. The output folder contains:
+#
+#   Norder{K}/Dir{D}/Npix{N}.fits (and .png), with D = (N / 10000) * 10000
+#   properties
+#   Moc.fits
+#
+# The pixels without coverage are NaN in the Fits tiles and transparent in
+# the PNG tiles, and the tiles without coverage are not written.
+# The twelve base tiles are written in parallel.
+
+import os
+import time
+import multiprocessing
+import numpy as np
+from astropy.io import fits
+from utils import healpix_helper as hpHelper
+from utils import exception_helper as ExHelper
+from utils import cache_helper as cacheHelper
+
+HIPS_FORMATS = [ "fits", "png" ]
+
+# Parameters of the faces written by a process (see write_face), set once per
+# worker process so the image is not sent with each face
+FACE_PARAMS = None
+
+
+# Returns the NESTED index of each pixel of a tile relative to the first pixel of the
+# tile, as stored in a Fits tile (row 0 is the first row of the Fits data)
+def get_tile_indices(tile_width):
+    rows, cols = np.indices((tile_width, tile_width))
+    return hpHelper.spread_bits(tile_width - 1 - rows) + (hpHelper.spread_bits(cols) << 1)
+
+
+# Returns the path of a tile without the extension
+def get_tile_path(output_folder, order, npix):
+    return os.path.join(output_folder, "Norder" + str(order),
+                        "Dir" + str((npix // 10000) * 10000), "Npix" + str(npix))
+
+
+# Returns the indices of the pixels of the all sky image (CAR or HEALPix) that
+# contain the given coordinates
+def get_image_indices(img, ras, decs):
+
+    if img.ndim == 1:
+        return hpHelper.ang2pix(hpHelper.npix2nside(img.shape[0]), ras, decs)
+
+    scale = img.shape[1] / 360.0
+    rows = np.clip((decs + 90.0) * scale, 0, img.shape[0] - 1).astype(int)
+    cols = np.clip(ras * scale, 0, img.shape[1] - 1).astype(int)
+    return rows, cols
+
+
+# Samples the all sky image at the centers of the pixels of a tile,
+# the pixels without coverage are NaN
+def sample_tile(img, coverage, order, npix, tile_indices):
+
+    tile_width = tile_indices.shape[0]
+    nside = hpHelper.order2nside(order) * tile_width
+    ras, decs = hpHelper.pix2ang(nside, npix * tile_width * tile_width + tile_indices)
+
+    indices = get_image_indices(img, ras, decs)
+    tile = np.array(img[indices], dtype=np.float32)
+    if coverage is not None:
+        tile[~coverage[indices]] = np.nan
+
+    return tile
+
+
+# Builds a tile from its four children averaging each 2x2 block of pixels,
+# the children without coverage are None
+def merge_children(children, tile_width):
+
+    half = tile_width // 2
+    total = np.zeros((tile_width, tile_width), dtype=np.float32)
+    count = np.zeros((tile_width, tile_width), dtype=np.float32)
+
+    for child_idx, child in enumerate(children):
+        if child is None:
+            continue
+
+        blocks = child.reshape(half, 2, half, 2)
+        valid = ~np.isnan(blocks)
+
+        row = (1 - (child_idx & 1)) * half
+        col = (child_idx >> 1) * half
+        total[row:row + half, col:col + half] = np.where(valid, blocks, 0).sum(axis=(1, 3))
+        count[row:row + half, col:col + half] = valid.sum(axis=(1, 3))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan).astype(np.float32)
+
+
+# Writes a tile in the given formats
+def write_tile(tile, output_folder, order, npix, formats, cut):
+
+    path = get_tile_path(output_folder, order, npix)
+    cacheHelper.make_folder(os.path.dirname(path))
+
+    if "fits" in formats:
+        header = fits.Header()
+        header["ORDER"] = order
+        header["NPIX"] = npix
+        fits.writeto(path + ".fits", tile, header=header, overwrite=True)
+
+    if "png" in formats:
+        import matplotlib.image as mpimg
+        mpimg.imsave(path + ".png", np.flipud(tile), cmap="gray", vmin=cut[0], vmax=cut[1])
+
+
+# Writes a tile and its descendants until max_order, returns the tile data
+# (None if it has no coverage). The tiles written are added to written, and the
+# covered cells of moc_order of the deepest tiles are added to moc_cells
+def write_tree(params, order, npix, written, moc_cells):
+
+    img, coverage, output_folder, max_order, moc_order, formats, cut, tile_indices = params
+    tile_width = tile_indices.shape[0]
+
+    if order == max_order:
+        tile = sample_tile(img, coverage, order, npix, tile_indices)
+        valid = ~np.isnan(tile)
+        if not np.any(valid):
+            return None
+
+        pixel_order = max_order + hpHelper.nside2order(tile_width)
+        pixels = npix * tile_width * tile_width + tile_indices[valid]
+        moc_cells.append(np.unique(pixels >> (2 * (pixel_order - moc_order))))
+
+    else:
+        children = [ write_tree(params, order + 1, npix * 4 + child_idx, written, moc_cells)
+                     for child_idx in range(4) ]
+        if all(child is None for child in children):
+            return None
+
+        tile = merge_children(children, tile_width)
+
+    write_tile(tile, output_folder, order, npix, formats, cut)
+    written.append((order, npix))
+    return tile
+
+
+def set_face_params(params):
+    global FACE_PARAMS
+    FACE_PARAMS = params
+
+
+# Writes the tiles of a base tile (face) with the FACE_PARAMS, returns the tiles
+# written, the covered MOC cells and the error message if fails
+def write_face(face):
+
+    written = []
+    moc_cells = []
+    try:
+        write_tree(FACE_PARAMS, 0, face, written, moc_cells)
+        error = None
+    except:
+        error = ExHelper.getWarnMsg()
+
+    moc_cells = np.concatenate(moc_cells) if len(moc_cells) else np.array([], dtype=np.int64)
+    return written, moc_cells, error
+
+
+# Returns the NUNIQ cells of the MOC of the given covered cells of moc_order,
+# merging the groups of four sibling cells into their parent
+def get_moc_uniq(cells, moc_order):
+
+    uniq = []
+    cells = np.unique(cells)
+    for order in range(moc_order, -1, -1):
+        if order > 0:
+            parents, counts = np.unique(cells >> 2, return_counts=True)
+            full_parents = parents[counts == 4]
+            is_child = np.isin(cells >> 2, full_parents)
+        else:
+            full_parents = np.array([], dtype=np.int64)
+            is_child = np.zeros(len(cells), dtype=bool)
+
+        uniq.append(4 * (4 ** order) + cells[~is_child])
+        cells = full_parents
+
+    return np.sort(np.concatenate(uniq))
+
+
+# Writes the MOC as a Fits file in NUNIQ ordering
+def write_moc(filename, uniq, moc_order):
+
+    column = fits.Column(name="UNIQ", format="K", array=uniq.astype(np.int64))
+    hdu = fits.BinTableHDU.from_columns([column])
+    hdu.header["PIXTYPE"] = "HEALPIX"
+    hdu.header["ORDERING"] = "NUNIQ"
+    hdu.header["COORDSYS"] = "C"
+    hdu.header["MOCORDER"] = moc_order
+    hdu.header["MOCTOOL"] = "apollo15"
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=True)
+
+
+# Writes the HiPS properties file
+def write_properties(filename, properties):
+
+    with open(filename, "w") as properties_file:
+        for key, value in properties:
+            properties_file.write(key.ljust(22) + " = " + str(value) + "\n")
+
+
+# Writes the all sky image (CAR projection, Dec -90 in row 0 and RA 0 in column 0, or
+# a HEALPix NESTED map) as a HiPS in output_folder. coverage is the mask of the image
+# pixels with data. If order is None the order is chosen from the image resolution.
+# Returns a dictionary with the order, the number of tiles written and the sky fraction
+def save_hips(img, output_folder, coverage=None, order=None, tile_width=512,
+             formats=HIPS_FORMATS, title="Apollo 15 XRFS All Sky Map", workers=1):
+
+    # Order of the HEALPix pixels matching the image pixels, and finest MOC order
+    # with cells not smaller than them
+    if img.ndim == 1:
+        pixel_order = hpHelper.nside2order(hpHelper.npix2nside(img.shape[0]))
+        moc_max_order = pixel_order
+    else:
+        pixel_order = hpHelper.scale2order(img.shape[1] / 360.0)
+        moc_max_order = pixel_order - 1
+
+    tile_order = hpHelper.nside2order(tile_width)
+    if order is None:
+        order = max(0, pixel_order - tile_order)
+
+    moc_order = max(order, min(order + tile_order, moc_max_order))
+
+    valid_values = img[coverage] if coverage is not None else img
+    cut = (float(np.min(valid_values)), float(np.max(valid_values))) if valid_values.size else (0.0, 1.0)
+
+    params = (img, coverage, output_folder, order, moc_order, formats, cut, get_tile_indices(tile_width))
+    faces = range(12)
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=set_face_params, initargs=(params,))
+        try:
+            results = pool.map(write_face, faces, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        set_face_params(params)
+        try:
+            results = [ write_face(face) for face in faces ]
+        finally:
+            set_face_params(None)
+
+    written = [ tile for result in results for tile in result[0] ]
+    moc_cells = np.concatenate([ result[1] for result in results ])
+    failed = [ (face, result[2]) for face, result in enumerate(results) if result[2] is not None ]
+
+    uniq = get_moc_uniq(moc_cells, moc_order)
+    write_moc(os.path.join(output_folder, "Moc.fits"), uniq, moc_order)
+
+    sky_fraction = float(len(np.unique(moc_cells))) / hpHelper.nside2npix(hpHelper.order2nside(moc_order))
+    tile_nside = hpHelper.order2nside(order) * tile_width
+
+    write_properties(os.path.join(output_folder, "properties"), [
+        ("creator_did", "ivo://apollo15/P/" + title.replace(" ", "_")),
+        ("obs_title", title),
+        ("dataproduct_type", "image"),
+        ("hips_version", "1.4"),
+        ("hips_builder", "apollo15 hips_helper"),
+        ("hips_release_date", time.strftime("%Y-%m-%dT%H:%MZ", time.gmtime())),
+        ("hips_status", "public master clonableOnce"),
+        ("hips_frame", "equatorial"),
+        ("hips_order", order),
+        ("hips_order_min", 0),
+        ("hips_tile_width", tile_width),
+        ("hips_tile_format", " ".join(formats)),
+        ("hips_pixel_bitpix", -32),
+        ("hips_pixel_cut", str(cut[0]) + " " + str(cut[1])),
+        ("hips_data_range", str(cut[0]) + " " + str(cut[1])),
+        ("hips_pixel_scale", hpHelper.nside2resol(tile_nside)),
+        ("hips_initial_ra", 0.0),
+        ("hips_initial_dec", 0.0),
+        ("hips_initial_fov", 180.0),
+        ("moc_sky_fraction", sky_fraction)
+    ])
+
+    print('Saved HiPS of order ' + str(order) + ' with ' + str(len(written)) + ' tiles of '
+          + str(tile_width) + 'x' + str(tile_width) + 'px in: ' + output_folder)
+    for face, error in failed:
+        print('Failed base tile ' + str(face) + ': ' + error)
+
+    return { "order": order, "tiles": len(written), "moc_order": moc_order,
+             "sky_fraction": sky_fraction }
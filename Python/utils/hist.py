@@ -1,27 +1,70 @@
 import numpy as np
 
-def imhist(im):
-  # calculates normalized histogram of an image
-	m, n = im.shape
-	h = [0.0] * 256
-	for i in range(m):
-		for j in range(n):
-			h[int(im[i, j])]+=1
-	return np.array(h)/(m*n)
+def imhist(im, nbins=256):
+	# calculates normalized histogram of an image
+	idx = np.asarray(im).astype(int).ravel()
+	return np.bincount(idx, minlength=nbins) / float(idx.size)
 
 def cumsum(h):
 	# finds cumulative sum of a numpy array, list
-	return [sum(h[:i+1]) for i in range(len(h))]
+	return np.cumsum(h)
 
-def histeq(im):
-	#calculate Histogram
-	h = imhist(im)
-	cdf = np.array(cumsum(h)) #cumulative distribution function
+def tobins(im, nbins):
+	# maps the image values linearly from min..max to bin indices 0..nbins-1
+	lo, hi = np.nanmin(im), np.nanmax(im)
+	if hi <= lo:
+		return np.zeros(im.shape, dtype=int)
+	idx = ((im - lo) * (nbins / float(hi - lo))).astype(int)
+	return np.clip(idx, 0, nbins - 1)
+
+def normalize(im, lo=None, hi=None):
+	# maps the image values linearly from lo..hi (min..max by default) to 0..1
+	lo = np.nanmin(im) if lo is None else lo
+	hi = np.nanmax(im) if hi is None else hi
+	if hi <= lo:
+		return np.zeros(im.shape)
+	return np.clip((im - lo) / float(hi - lo), 0.0, 1.0)
+
+def histeq(im, nbins=None):
+	# equalizes an image with integer values in 0..255, or any image binned in
+	# nbins (256 by default if its values are not integers in 0..255)
+	im = np.asarray(im)
+	if nbins is None and np.min(im) >= 0 and np.max(im) < 256 \
+			and (np.issubdtype(im.dtype, np.integer) or np.all(np.mod(im, 1) == 0)):
+		idx = im.astype(int)
+		nbins = 256
+	else:
+		nbins = 256 if nbins is None else nbins
+		idx = tobins(im, nbins)
+	#calculate Histogram and cumulative distribution function
+	cdf = np.cumsum(np.bincount(idx.ravel(), minlength=nbins) / float(idx.size))
 	sk = np.uint8(255 * cdf) #finding transfer function values
-	s1, s2 = im.shape
-	Y = np.zeros_like(im)
 	# applying transfered values for each pixels
-	for i in range(0, s1):
-		for j in range(0, s2):
-			Y[i, j] = sk[int(im[i, j])]
-	return Y
+	return sk[idx].astype(im.dtype)
+
+def linear(im):
+	return 255 * normalize(im)
+
+def sqrt(im):
+	return 255 * np.sqrt(normalize(im))
+
+def log(im, a=1000.0):
+	return 255 * np.log1p(a * normalize(im)) / np.log1p(a)
+
+def asinh(im, beta=0.1):
+	return 255 * np.arcsinh(normalize(im) / beta) / np.arcsinh(1.0 / beta)
+
+def percentile(im, low=1.0, high=99.0):
+	# clips the image to the given percentiles
+	lo, hi = np.nanpercentile(im, [low, high])
+	return 255 * normalize(im, lo, hi)
+
+# Available stretch functions, all of them return values in range 0..255
+STRETCHES = { "histeq": histeq, "linear": linear, "sqrt": sqrt, "log": log,
+	"asinh": asinh, "percentile": percentile }
+
+def stretch(im, method="histeq", **kwargs):
+	# applies the stretch function named method, kwargs are passed to it
+	if method not in STRETCHES:
+		raise ValueError("Unknown stretch method: " + str(method))
+	return STRETCHES[method](np.asarray(im), **kwargs)
@@ -1,11 +1,13 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import multiprocessing
 import numpy as np
 import scipy.misc
 from astropy.io import fits
 from astropy.wcs import WCS
 import utils.exception_helper as ExHelper
+from utils import healpix_map_helper as hpMapHelper
 import constants as consts
 
 MAX_W = (360 * consts.IMG_SCALE)
@@ -19,6 +21,43 @@ consts.MRSC = scipy.misc.imresize(consts.MRSC, FOV_SCALE * consts.IMG_SCALE, int
 MRSC_SIZE = len(consts.MRSC)
 MRSC_CENTER = int(MRSC_SIZE/2)
 
+# Offsets from the MRSC center and ratios of the non zero MRSC elements,
+# used for projecting many observations at once
+MRSC_DEC_OFFSETS, MRSC_RA_OFFSETS = np.nonzero(consts.MRSC)
+MRSC_RATIOS = consts.MRSC[MRSC_DEC_OFFSETS, MRSC_RA_OFFSETS] / 100.0
+MRSC_DEC_OFFSETS = MRSC_DEC_OFFSETS - MRSC_CENTER
+MRSC_RA_OFFSETS = MRSC_RA_OFFSETS - MRSC_CENTER
+
+# Max number of projected MRSC elements computed at once by drawFOVs
+FOV_CHUNK_SIZE = 1 << 22
+
+# With "auto" method the MRSC is applied with FFTs if its non zero elements times
+# the pixels with observations are more than this value times the number of
+# pixels times its log2
+FFT_KERNEL_FACTOR = 0.25
+
+# FFT of the MRSC placed over an all sky map, computed the first time is needed
+MRSC_FFT = None
+
+# Radius of the MRSC in map rows, from the farthest corner of its non zero elements
+MRSC_ROW_RADIUS = int(np.ceil(np.max(np.hypot(np.abs(MRSC_DEC_OFFSETS) + 0.5,
+                                              np.abs(MRSC_RA_OFFSETS) + 0.5)))) + 1
+
+# Max bytes of the MRSC kernels of the "spherical" method kept between calls. The
+# kernels are computed the first time each Dec row is needed and kept until the
+# limit is reached, the rest are computed on each call
+SPHERICAL_CACHE_SIZE = 256 << 20
+
+# MRSC kernels of the "spherical" method by IMG_SCALE and Dec row, and their bytes
+MRSC_ROW_KERNELS = {}
+MRSC_ROW_KERNELS_SIZE = 0
+
+# Angular radius of the MRSC (degrees), from the farthest corner of its non zero
+# elements along the East and North directions
+MRSC_RADIUS = np.degrees(np.max(np.arctan(np.hypot(
+                    np.tan(np.radians((np.abs(MRSC_DEC_OFFSETS) + 0.5) * consts.FOV / MRSC_SIZE)),
+                    np.tan(np.radians((np.abs(MRSC_RA_OFFSETS) + 0.5) * consts.FOV / MRSC_SIZE))))))
+
 
 # drawFOV: Projects value (energy or counts..) over the image data using the MRSC data
 #          in a given coordinates. Also upadates the exposure_map if passed
@@ -39,37 +78,385 @@ def drawFOV (ra, dec, value, img_data, exposure_map):
     return img_data
 
 
-# Saves an image as FITS with WCS information
-def saveImage (imageData, ra, dec, scale, fileName):
+# drawFOVs: Same as drawFOV but for arrays of coordinates and values.
+#           Methods:
+#             scatter: scatter-add of the MRSC ratios over each observation.
+#             direct: bins the observations on the map and scatter-adds the
+#                     MRSC ratios over each pixel with observations.
+#             fft: bins the observations on the map and convolves them with
+#                  the MRSC using FFTs.
+#             spherical: bins the observations on the map and projects the MRSC
+#                        rotated on the sphere to each Dec row (see
+#                        convolveMRSCSpherical), correct at high Declinations.
+#             auto: direct or fft depending on the MRSC size and the number
+#                   of pixels with observations.
+def drawFOVs (ras, decs, values, img_data, exposure_map, method="scatter"):
 
-    try:
-        # Initialize WCS information, http://docs.astropy.org/en/stable/wcs/
-        wcs = WCS(naxis=2)
+    values = np.asarray(values, dtype=float)
+    drawFOVCube(ras, decs, values[:, np.newaxis], img_data[np.newaxis],
+                exposure_map, method=method)
+
+    return img_data
+
+
+# drawFOVCube: Same as drawFOVs but values has one column per channel and each
+#              channel is projected over its map of the cube (channels x H x W).
+#              The observations are located once for all the channels and the
+#              exposure map is shared.
+def drawFOVCube (ras, decs, values, cube, exposure_map, method="scatter"):
+
+    ras = np.asarray(ras, dtype=np.int64)
+    decs = np.asarray(decs, dtype=np.int64)
+    values = np.asarray(values, dtype=float).reshape((len(ras), -1))
+
+    if method == "scatter":
+        scatterFOVs(ras, decs, values, cube, exposure_map)
+        return cube
+
+    values_bins, counts_bins = binObservations(ras, decs, values)
+    values_maps, exposure = convolveBins(values_bins, counts_bins, method)
+
+    cube += values_maps
+    exposure_map += exposure
+
+    return cube
+
+
+# Applies the MRSC to the binned values (cube) and counts of the observations with
+# the given method (direct, fft, spherical or auto), returns the values cube and
+# the exposure map
+def convolveBins (values_bins, counts_bins, method="auto"):
+
+    if method == "auto":
+        n_pixels = MAX_H * MAX_W
+        if np.count_nonzero(counts_bins) * len(MRSC_RATIOS) > FFT_KERNEL_FACTOR * n_pixels * np.log2(n_pixels):
+            method = "fft"
+        else:
+            method = "direct"
+
+    if method == "direct":
+        result = convolveMRSCDirect(np.concatenate([values_bins, counts_bins[np.newaxis]]))
+        return result[:-1], result[-1]
+
+    if method == "fft":
+        return convolveMRSCFFT(values_bins), convolveMRSCFFT(counts_bins)
+
+    if method == "spherical":
+        result = convolveMRSCSpherical(np.concatenate([values_bins, counts_bins[np.newaxis]]))
+        return result[:-1], result[-1]
+
+    raise ValueError("Unknown projection method: " + str(method))
+
+
+# Scatter-adds the MRSC ratios over each observation, in chunks of observations.
+# The exposure map is not updated if it is None
+def scatterFOVs (ras, decs, values, cube, exposure_map=None):
+
+    n_pixels = MAX_H * MAX_W
+    chunk_size = max(1, FOV_CHUNK_SIZE // len(MRSC_RATIOS))
+
+    for start in range(0, len(ras), chunk_size):
+        end = start + chunk_size
+
+        f_ra = (ras[start:end, np.newaxis] + MRSC_RA_OFFSETS) % MAX_W
+        f_dec = (decs[start:end, np.newaxis] + MRSC_DEC_OFFSETS) % MAX_H
+        f_idx = (f_dec * MAX_W + f_ra).ravel()
+
+        for channel in range(values.shape[1]):
+            weights = (values[start:end, channel, np.newaxis] * MRSC_RATIOS).ravel()
+            cube[channel] += np.bincount(f_idx, weights=weights,
+                                         minlength=n_pixels).reshape((MAX_H, MAX_W))
+
+        if exposure_map is not None:
+            weights = np.tile(MRSC_RATIOS, len(f_ra))
+            exposure_map += np.bincount(f_idx, weights=weights,
+                                        minlength=n_pixels).reshape(exposure_map.shape)
+
+
+# Returns the sum of values of each channel and the number of observations on
+# each map pixel. Values has one column per channel.
+def binObservations (ras, decs, values):
+
+    n_pixels = MAX_H * MAX_W
+    idx = (decs % MAX_H) * MAX_W + (ras % MAX_W)
+
+    values_bins = np.zeros((values.shape[1], MAX_H, MAX_W))
+    for channel in range(values.shape[1]):
+        values_bins[channel] = np.bincount(idx, weights=values[:, channel],
+                                           minlength=n_pixels).reshape((MAX_H, MAX_W))
+
+    counts_bins = np.bincount(idx, minlength=n_pixels).astype(float)
+
+    return values_bins, counts_bins.reshape((MAX_H, MAX_W))
+
+
+# Applies the MRSC to a binned map, or a cube of them, scatter-adding the MRSC
+# ratios over the pixels with observations only (periodic in RA and Dec)
+def convolveMRSCDirect (bins):
+
+    cube = bins.reshape((-1, MAX_H, MAX_W))
+    decs, ras = np.nonzero(np.any(cube != 0, axis=0))
+
+    result = np.zeros(cube.shape)
+    scatterFOVs(ras, decs, cube[:, decs, ras].T, result)
+
+    return result.reshape(bins.shape)
+
+
+# Applies the MRSC to a binned map, or a cube of them, with a periodic
+# convolution using FFTs
+def convolveMRSCFFT (bins):
+    global MRSC_FFT
+
+    if MRSC_FFT is None:
+        kernel = np.zeros((MAX_H, MAX_W))
+        np.add.at(kernel, (MRSC_DEC_OFFSETS % MAX_H, MRSC_RA_OFFSETS % MAX_W), MRSC_RATIOS)
+        MRSC_FFT = np.fft.rfft2(kernel)
+
+    return np.fft.irfft2(np.fft.rfft2(bins) * MRSC_FFT, s=bins.shape[-2:])
+
+
+# Returns the MRSC rotated on the sphere to the center of the pixel (dec_row, 0), as
+# the first map row and column and the kernel over the map rows and columns it
+# covers (the columns are periodic in RA). Each map pixel takes the MRSC element
+# of its angular offsets to the center along the local East and North directions.
+# Only the columns inside the MRSC radius are evaluated, all of them if it covers
+# a pole. The kernel of a pixel (dec_row, ra) is the same shifted ra columns.
+def computeSphericalKernel (dec_row):
+
+    cell = consts.FOV / float(MRSC_SIZE) # Degrees per MRSC element
+    first_row = max(0, dec_row - MRSC_ROW_RADIUS)
+    last_row = min(MAX_H, dec_row + MRSC_ROW_RADIUS + 1)
+
+    center_dec = np.radians((dec_row + 0.5) / consts.IMG_SCALE - 90.0)
+    decs = np.radians((np.arange(first_row, last_row) + 0.5) / consts.IMG_SCALE - 90.0)[:, np.newaxis]
+
+    # Max RA offset of a circle of radius MRSC_RADIUS centered at center_dec
+    max_sin = np.sin(np.radians(MRSC_RADIUS)) / np.cos(center_dec)
+    half_width = int(np.ceil(np.degrees(np.arcsin(min(max_sin, 1.0))) * consts.IMG_SCALE)) + 1
+    if max_sin < 1.0 and 2 * half_width + 1 < MAX_W:
+        ra_cols = np.arange(-half_width, half_width + 1)
+    else:
+        ra_cols = np.arange(MAX_W)
+    ra_offsets = np.radians(ra_cols / float(consts.IMG_SCALE))
+
+    # Coordinates of the map pixels along the center, East and North axes of the kernel center
+    center_dist = (np.cos(decs) * np.cos(ra_offsets) * np.cos(center_dec)
+                   + np.sin(decs) * np.sin(center_dec))
+    east = np.cos(decs) * np.sin(ra_offsets)
+    north = (np.cos(center_dec) * np.sin(decs)
+             - np.sin(center_dec) * np.cos(decs) * np.cos(ra_offsets))
+
+    local_coords = np.stack(np.broadcast_arrays(center_dist, east, north), axis=-1)
+    kernel = hpMapHelper.get_kernel_ratios(local_coords, consts.MRSC / 100.0, cell)
 
-        # Use the center of the image as projection center
-        wcs.wcs.crpix = [imageData.shape[1] / 2. + 0.5,
-                         imageData.shape[0] / 2. + 0.5]
+    return first_row, ra_cols[0], kernel.astype(np.float32)
 
-        # Set the coordinates of the image center
-        wcs.wcs.crval = [ra, dec] # Aladin RA goes from 0 to 360 (for J2000)
 
-        # Set the pixel scale (in deg/pix)
-        wcs.wcs.cdelt = [scale, scale]
+# Returns the kernel of computeSphericalKernel, keeping it in MRSC_ROW_KERNELS
+# while they take less than SPHERICAL_CACHE_SIZE bytes
+def getSphericalKernel (dec_row):
+    global MRSC_ROW_KERNELS_SIZE
 
-        # Set the coordinate system
-        wcs.wcs.ctype = ['RA---CAR', 'DEC--CAR'] # ['GLON-CAR', 'GLAT-CAR'] # ra, dec
+    key = (consts.IMG_SCALE, dec_row)
+    if key in MRSC_ROW_KERNELS:
+        return MRSC_ROW_KERNELS[key]
 
-        # And produce a FITS header
-        header = wcs.to_header()
+    row_kernel = computeSphericalKernel(dec_row)
+    if MRSC_ROW_KERNELS_SIZE + row_kernel[2].nbytes <= SPHERICAL_CACHE_SIZE:
+        MRSC_ROW_KERNELS[key] = row_kernel
+        MRSC_ROW_KERNELS_SIZE += row_kernel[2].nbytes
+
+    return row_kernel
+
+
+# Applies the MRSC rotated on the sphere to a binned map, or a cube of them. For each
+# Dec row with observations its kernel is convolved along RA (periodic) with the row
+# using FFTs, so the trigonometry is only evaluated once for each Dec row. The
+# convolutions are accumulated in the frequency domain and transformed back at once
+def convolveMRSCSpherical (bins):
+
+    cube = bins.reshape((-1, MAX_H, MAX_W))
+    cube_fft = np.fft.rfft(cube, axis=-1)
+    result_fft = np.zeros(cube_fft.shape, dtype=complex)
+
+    for dec_row in np.nonzero(np.any(cube != 0, axis=(0, 2)))[0]:
+        first_row, first_col, row_kernel = getSphericalKernel(dec_row)
+
+        kernel = np.zeros((row_kernel.shape[0], MAX_W))
+        kernel[:, (first_col + np.arange(row_kernel.shape[1])) % MAX_W] = row_kernel
+        kernel_fft = np.fft.rfft(kernel, axis=-1)
+
+        result_fft[:, first_row:first_row + len(kernel)] += cube_fft[:, dec_row, np.newaxis, :] * kernel_fft
+
+    return np.fft.irfft(result_fft, n=MAX_W, axis=-1).reshape(bins.shape)
+
+
+# Returns the weighted average map dividing the energy (or counts) map by the
+# exposure map where the exposure is above min_exposure (MIN_EXPOSURE by default),
+# zero elsewhere
+def getFluxMap (energy_map, exposure_map, min_exposure=None):
+
+    min_exposure = consts.MIN_EXPOSURE if min_exposure is None else min_exposure
+
+    flux_map = np.zeros(energy_map.shape)
+    np.divide(energy_map, exposure_map, out=flux_map, where=exposure_map > min_exposure)
+
+    return flux_map
+
+
+# Calibrates the map values in range 0..colors (COLORS by default) as integers.
+#   Methods:
+#     max: divides the positive values by the max value, the rest are kept.
+#     minmax: maps the min..max range.
+#     percentile: maps the range between the percentiles, clipping the values outside.
+def calibrateMap (flux_map, method="max", colors=None, percentiles=(1.0, 99.0)):
+
+    colors = consts.COLORS if colors is None else colors
+
+    if method == "max":
+        calibrated_map = flux_map.copy()
+        max_flux = np.max(flux_map)
+        if max_flux > 0:
+            positive = flux_map > 0
+            calibrated_map[positive] = np.trunc((flux_map[positive] / max_flux) * colors)
+        return calibrated_map
+
+    if method == "minmax":
+        min_flux, max_flux = np.min(flux_map), np.max(flux_map)
+    elif method == "percentile":
+        min_flux, max_flux = np.percentile(flux_map, percentiles)
+    else:
+        raise ValueError("Unknown calibration method: " + str(method))
+
+    if max_flux <= min_flux:
+        return np.zeros(flux_map.shape)
+
+    flux_map = np.clip(flux_map, min_flux, max_flux)
+    return np.trunc(((flux_map - min_flux) / (max_flux - min_flux)) * colors)
+
+
+# Returns a FITS header with the WCS information of an image of the given shape
+# centered on ra, dec
+def getWCSHeader (shape, ra, dec, scale):
+
+    # Initialize WCS information, http://docs.astropy.org/en/stable/wcs/
+    wcs = WCS(naxis=2)
+
+    # Use the center of the image as projection center
+    wcs.wcs.crpix = [shape[1] / 2. + 0.5,
+                     shape[0] / 2. + 0.5]
+
+    # Set the coordinates of the image center
+    wcs.wcs.crval = [ra, dec] # Aladin RA goes from 0 to 360 (for J2000)
+
+    # Set the pixel scale (in deg/pix)
+    wcs.wcs.cdelt = [scale, scale]
+
+    # Set the coordinate system
+    wcs.wcs.ctype = ['RA---CAR', 'DEC--CAR'] # ['GLON-CAR', 'GLAT-CAR'] # ra, dec
+
+    # And produce a FITS header
+    return wcs.to_header()
+
+
+# Saves an image as FITS with WCS information
+def saveImage (imageData, ra, dec, scale, fileName):
+
+    try:
+        header = getWCSHeader(imageData.shape, ra, dec, scale)
 
         #Avoid transparent color in Aladin HipsGen
         if consts.GEN_ALADIN_READY_FITS:
             imageData[imageData < 1] = 1
 
         # We can also just output one of the wavelengths
-        fits.writeto(fileName, imageData, header=header, clobber=True)
+        fits.writeto(fileName, imageData, header=header, overwrite=True)
 
         print('Saved: ' + fileName)
 
     except:
         print(ExHelper.getException('saveImage'))
+
+
+# Writes a tile (imageData, header, fileName) as FITS, returns the error message if fails
+def writeTile (tile):
+
+    imageData, header, fileName = tile
+    try:
+        fits.writeto(fileName, imageData, header=header, overwrite=True)
+        return None
+
+    except:
+        return ExHelper.getWarnMsg()
+
+
+# Splits the all sky image in a grid of images of 2 * clip_angle degrees and saves
+# each one as a WCS Fits Image in the output folder. The image centers RA and Dec
+# fall in the odd multiples of clip_angle. The images are written by a pool of
+# workers processes (EXPORT_WORKERS by default), and a summary is printed at the end.
+# Returns the manifest of the tiles: [ [filename, ra, dec, avg, min, max], ... ]
+def saveTiles (img, output_folder, clip_angle=4, workers=None):
+
+    workers = consts.EXPORT_WORKERS if workers is None else workers
+
+    clip_angle2 = clip_angle * 2 # Total angular size of the clipped image
+    scaled_clip_angle = clip_angle * consts.IMG_SCALE
+    deg_px_ratio = (1.0 + 0.1)/consts.IMG_SCALE # 0.1 for overlaying margin (for Aladin HiPS Gen)
+
+    # All the tiles have the same header except the coordinates of the center
+    size = scaled_clip_angle * 2
+    template_header = getWCSHeader((size, size), 0.0, 0.0, deg_px_ratio)
+
+    # The poles depend on the center, without them the defaults for each center are used
+    for keyword in ['LONPOLE', 'LATPOLE']:
+        template_header.remove(keyword, ignore_missing=True)
+
+    # Clip images
+    tiles = []
+    manifest = []
+    for dec in range(clip_angle, 180, clip_angle2):
+        for ra in range(clip_angle, 360, clip_angle2):
+            ra_int = int(ra * consts.IMG_SCALE)
+            dec_int = int(dec * consts.IMG_SCALE)
+
+            clipped_img = np.array(img[ dec_int - scaled_clip_angle : dec_int + scaled_clip_angle,
+                                   ra_int - scaled_clip_angle : ra_int + scaled_clip_angle ], dtype=np.uint8)
+
+            avg_value = int(np.average(clipped_img))
+            min_value = int(np.min(clipped_img))
+            max_value = int(np.max(clipped_img))
+
+            #Avoid transparent color in Aladin HipsGen
+            if consts.GEN_ALADIN_READY_FITS:
+                clipped_img[clipped_img < 1] = 1
+
+            header = template_header.copy()
+            header['CRVAL1'] = float(ra)
+            header['CRVAL2'] = float(dec - 90)
+
+            #FILENAME: /DEC_RA_AVG_MIN_MAX.fits
+            filename = output_folder + 'fits_' + str(dec) + '_' + str(ra) + '_' + str(avg_value) + '_' + str(min_value) + '_' + str(max_value) + '.fits'
+            tiles.append((clipped_img, header, filename))
+            manifest.append([filename, ra, dec - 90, avg_value, min_value, max_value])
+
+    # Save as Fits
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            errors = pool.map(writeTile, tiles, chunksize=max(1, len(tiles) // (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = [ writeTile(tile) for tile in tiles ]
+
+    failed = [ (tile[2], error) for tile, error in zip(tiles, errors) if error is not None ]
+
+    print('Saved ' + str(len(tiles) - len(failed)) + ' of ' + str(len(tiles)) + ' Fits images of '
+          + str(size) + 'x' + str(size) + 'px (' + str(clip_angle2) + 'x' + str(clip_angle2)
+          + ' deg) in: ' + output_folder)
+    for filename, error in failed:
+        print('Failed: ' + filename + ': ' + error)
+
+    return manifest
@@ -1,134 +1,280 @@
 import numpy as np
-import bisect
+import itertools
+from utils import gti as gtiHelper
+from utils import cache_helper as cacheHelper
+from utils import pds_helper as pdsHelper
 import constants as consts
 
+# Loads the ligthcurve file. The NASA PDS XRFS tables (.tab) are converted to the
+# same format summing the channels of the LC_PDS_DETECTORS (see pds_helper)
 def get_ligthcurve(path):
-    return np.loadtxt(path)
 
-# Returns the background corrected total counts
-def get_total_counts(lc_row):
+    if path.lower().endswith(".tab"):
+        return pdsHelper.xrfs_tab_to_ligthcurve(pdsHelper.load_xrfs_tab(path))
+
+    return cacheHelper.loadtxt(path)
 
-    total_counts = 0
 
-    if lc_row[consts.LC_FLAG_COL] in consts.SUPPORTED_MODES:
+# Yields the ligthcurve file (same format as get_ligthcurve) in chunks of chunk_size
+# rows, reading only one chunk at once. If chunk_size is None the whole file is
+# loaded as one chunk
+def iter_ligthcurve_chunks(path, chunk_size=None):
+
+    if chunk_size is None:
+        yield get_ligthcurve(path)
+        return
+
+    is_pds = path.lower().endswith(".tab")
+
+    with open(path) as lc_file:
+        while True:
+            lines = list(itertools.islice(lc_file, chunk_size))
+            if len(lines) == 0:
+                break
+
+            if is_pds:
+                chunk = pdsHelper.xrfs_tab_to_ligthcurve(pdsHelper.parse_xrfs_tab(lines))
+            else:
+                chunk = np.loadtxt(lines, ndmin=2)
+
+            if len(chunk):
+                yield chunk
+
+
+# Ligthcurve data with the background corrected counts and the energies of
+# every channel computed as columns for all the rows at once.
+# Each column is computed the first time is requested and then cached.
+class Ligthcurve(object):
+
+    def __init__(self, data):
+        self.data = data
+        self._cache = {}
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(get_ligthcurve(path))
+
+    def __len__(self):
+        return len(self.data)
+
+    # Returns a new Ligthcurve with only the rows inside the gtis
+    def filter_by_gti(self, gtis):
+        return Ligthcurve(filter_by_gti(self.data, gtis, consts.LC_TIME_COL))
+
+    def _get_cached(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    @property
+    def times(self):
+        return self.data[:, consts.LC_TIME_COL]
 
-        for channel in range(consts.LC_FIRST_CHANNEL_COL,
-                            consts.LC_FIRST_CHANNEL_COL + consts.LC_NUM_CHANNELS):
-              
-            counts = lc_row[channel]
-            if counts > 0:
-                ch_idx = channel - consts.LC_FIRST_CHANNEL_COL
-                corrected_counts = counts - consts.LC_BACKGROUND[ch_idx]
-                total_counts += corrected_counts
+    @property
+    def modes(self):
+        return self.data[:, consts.LC_FLAG_COL]
+
+    # Counts of the channels range, one column per channel
+    @property
+    def channels(self):
+        return self.data[:, consts.LC_FIRST_CHANNEL_COL:
+                            consts.LC_FIRST_CHANNEL_COL + consts.LC_NUM_CHANNELS]
+
+    # True for the rows in one of the supported modes
+    @property
+    def supported_mask(self):
+        return self._get_cached("supported_mask",
+                                lambda: np.isin(self.modes, consts.SUPPORTED_MODES))
+
+    # True for the rows in extended mode
+    @property
+    def extended_mask(self):
+        return self._get_cached("extended_mask",
+                                lambda: self.modes == consts.EXTENDED_MODE)
+
+    # Background corrected counts per channel, zero for unsupported modes or no counts
+    @property
+    def corrected_counts(self):
+        return self._get_cached("corrected_counts", self._compute_corrected_counts)
+
+    def _compute_corrected_counts(self):
+        channels = self.channels
+        background = np.asarray(consts.LC_BACKGROUND[:consts.LC_NUM_CHANNELS])
+        valid = (channels > 0) & self.supported_mask[:, np.newaxis]
+        return np.where(valid, channels - background, 0.0)
+
+    # Poisson variance of the corrected_counts per channel: the counts of the channels
+    # included (with the background), zero for the rest
+    @property
+    def corrected_counts_variances(self):
+        return self._get_cached("corrected_counts_variances", self._compute_corrected_counts_variances)
+
+    def _compute_corrected_counts_variances(self):
+        valid = (self.channels > 0) & self.supported_mask[:, np.newaxis]
+        return np.where(valid, self.channels, 0.0)
+
+    # Background corrected total counts per row, channels without counts are not summed
+    @property
+    def total_counts(self):
+        return self._get_cached("total_counts",
+                                lambda: np.sum(self.corrected_counts, axis=1))
+
+    # Energy per channel: background corrected counts times the channel energy by
+    # second, zero if not above MIN_COUNTS or not positive
+    @property
+    def energies(self):
+        return self._get_cached("energies", self._compute_energies)
+
+    def _compute_energies(self):
+        channels = self.channels
+        background = np.asarray(consts.LC_BACKGROUND[:consts.LC_NUM_CHANNELS])
+        channel_energies = np.asarray(consts.CHANNEL_ENERGIES[:consts.LC_NUM_CHANNELS])
+
+        real_counts = channels - background
+        energies = (real_counts * channel_energies) / consts.LC_TIME_BIN
+
+        valid = (channels > 0) & self.supported_mask[:, np.newaxis] \
+                & (real_counts > consts.MIN_COUNTS) & (energies > 0)
+        energies = np.where(valid, energies, 0.0)
+
+        # Detector is in exetended mode
+        energies[self.extended_mask] *= consts.EXTENDED_MODE_FACTOR
 
-    return total_counts
+        return energies
+
+    # Sum of the energies of all channels per row
+    @property
+    def sum_of_energies(self):
+        return self._get_cached("sum_of_energies",
+                                lambda: np.sum(self.energies, axis=1))
+
+    # Poisson variance of the energies per channel, from the counts of the channels
+    # included in the energies (with the background)
+    @property
+    def energies_variances(self):
+        return self._get_cached("energies_variances", self._compute_energies_variances)
 
+    def _compute_energies_variances(self):
+        channel_energies = np.asarray(consts.CHANNEL_ENERGIES[:consts.LC_NUM_CHANNELS])
 
-# Multiplies the counts of a specified channel by the energy related to this channel.
-def get_energy(channel_col, lc_row):
-    energy = 0
+        variances = np.where(self.energies > 0,
+                             np.maximum(self.channels, 0) * (channel_energies / consts.LC_TIME_BIN) ** 2, 0.0)
+        variances[self.extended_mask] *= consts.EXTENDED_MODE_FACTOR ** 2
 
-    if lc_row[consts.LC_FLAG_COL] in consts.SUPPORTED_MODES \
-        and lc_row[channel_col] > 0:
+        return variances
 
-        ch_idx = channel_col - consts.LC_FIRST_CHANNEL_COL
-        real_counts = lc_row[channel_col] - consts.LC_BACKGROUND[ch_idx]
-        if real_counts <= consts.MIN_COUNTS:
-            return 0
+    # Poisson error of sum_of_energies per row
+    @property
+    def sum_of_energies_errors(self):
+        return self._get_cached("sum_of_energies_errors",
+                                lambda: np.sqrt(np.sum(self.energies_variances, axis=1)))
 
-        energy = (real_counts * consts.CHANNEL_ENERGIES[ch_idx]) / consts.LC_TIME_BIN
 
-        if energy <= 0:
-            return 0
+# Iterable over the Ligthcurve chunks of a file (see iter_ligthcurve_chunks) with only
+# the rows inside the gtis. The file is read again on each iteration, so only one
+# chunk is in memory at once.
+class LigthcurveChunks(object):
 
-        if lc_row[consts.LC_FLAG_COL] == consts.EXTENDED_MODE:
-            energy *= consts.EXTENDED_MODE_FACTOR  # Detector is in exetended mode
+    def __init__(self, path, chunk_size=None, gtis=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.gtis = gtis
 
-    return energy
+    def __iter__(self):
+        for data in iter_ligthcurve_chunks(self.path, self.chunk_size):
+            lc = Ligthcurve(data)
+            if self.gtis is not None:
+                lc = lc.filter_by_gti(self.gtis)
+            if len(lc):
+                yield lc
 
+    # Yields the chunks with only the rows whose projection changes, the sign of each
+    # row (1 for adding it, -1 for removing it) and the last time of the chunk.
+    # is_projected(times) returns the mask of the rows already projected, and the
+    # rows inside the gtis must be projected
+    def iter_changes(self, is_projected):
+        for data in iter_ligthcurve_chunks(self.path, self.chunk_size):
+            times = data[:, consts.LC_TIME_COL]
+            target = get_gti_mask(times, self.gtis) if self.gtis is not None else np.ones(len(data), dtype=bool)
 
-# Gets the sum of the energies of all channels
-def get_sum_of_energies(lc_row):
+            signs = target.astype(int) - is_projected(times)
+            changed = np.nonzero(signs)[0]
+            yield Ligthcurve(data[changed]), signs[changed], times[-1]
 
-    sum_of_energies = 0
-    for channel in range(consts.LC_FIRST_CHANNEL_COL,
-                        consts.LC_FIRST_CHANNEL_COL + consts.LC_NUM_CHANNELS):
-        sum_of_energies += get_energy(channel, lc_row)
 
-    return sum_of_energies
+# Returns the indices of the sorted times inside the gtis (start <= time <= end)
+def get_gti_indices(times, gtis):
 
+    gtis = np.asarray(gtis, dtype=float).reshape((-1, 2))
 
-# Finds the idx of the nearest value on the array, array must be sorted
-def find_idx_nearest_val(array, value):
+    starts = np.searchsorted(times, gtis[:, 0], side="left")
+    ends = np.searchsorted(times, gtis[:, 1], side="right")
+    lengths = np.maximum(ends - starts, 0)
 
-    # idx = np.searchsorted(array, value, side="left")
-    idx = bisect.bisect_left(array, value) # Looks like bisec is faster with structured data than searchsorted
+    # Concatenates the ranges starts..ends of all the gtis in one step
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(np.sum(lengths)) + offsets
 
-    if idx >= len(array):
-        idx_nearest = len(array) - 1
-    elif idx == 0:
-        idx_nearest = 0
-    else:
-        if abs(value - array[idx - 1]) < abs(value - array[idx]):
-            idx_nearest = idx - 1
-        else:
-            idx_nearest = idx
-    return idx_nearest
 
+# Returns the mask of the sorted times inside the gtis
+def get_gti_mask(times, gtis):
+    mask = np.zeros(len(times), dtype=bool)
+    mask[get_gti_indices(times, gtis)] = True
+    return mask
 
-# Returns a lightcurve filtered by gtis
-def filter_by_gti(lc, gtis, time_column=0):
 
-    flt_lc = np.array([]).reshape((0, lc.shape[1]))
-    start_event_idx = 0
-    end_event_idx = 0
+# Returns a lightcurve filtered by gtis. If return_indices is True returns the
+# indices of the rows inside the gtis instead of the rows. If all the rows are
+# in the same gti the result is a view of the lightcurve, not a copy.
+def filter_by_gti(lc, gtis, time_column=0, return_indices=False):
 
-    for gti_index in range(len(gtis)):
+    indices = get_gti_indices(lc[:, time_column], gtis)
 
-        start = gtis[gti_index][0]
-        end = gtis[gti_index][1]
+    if return_indices:
+        return indices
 
-        start_event_idx = find_idx_nearest_val(lc[:, time_column], start)
-        if (lc[start_event_idx, time_column] < start and start_event_idx < len(lc) - 1):
-            start_event_idx = start_event_idx + 1
+    if len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1:
+        return lc[indices[0]:indices[-1] + 1]
 
-        end_event_idx = find_idx_nearest_val(lc[:, time_column], end)
-        if (lc[end_event_idx, time_column] > end and end_event_idx > 0):
-            end_event_idx = end_event_idx - 1
+    return lc[indices]
 
-        if end_event_idx >= start_event_idx:
-            flt_lc = np.concatenate((flt_lc, lc[start_event_idx:end_event_idx, :]))
 
-    return flt_lc
+# Returns the GTIs where the mask is True, from the first to the last time of
+# each run of consecutive True values. Runs with only one time are dismissed.
+def get_gtis_from_mask(times, mask):
 
+    edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0] - 1
+
+    gtis = np.column_stack((times[starts], times[ends]))
+    return gtis[gtis[:, 1] > gtis[:, 0]]
 
-# Extracts a GTI array from a BODY-Theta_Phi file with a given threshold
-def get_gtis_from_file(path, threshold):
 
-    data = np.loadtxt(path, delimiter=",") # Load the CSV file
-    rows = len(data)
+# Extracts a GTI array from a BODY-Theta_Phi file with a given threshold
+def get_gtis_from_file(path, threshold, theta_col=1):
 
-    gtis = []
-    gtiStart = -1
-    gtiEnd = -1
+    data = cacheHelper.loadtxt(path, delimiter=",", ndmin=2) # Load the CSV file
+    return get_gtis_from_mask(data[:, 0], data[:, theta_col] > threshold)
 
-    if rows > 0:
-        for i in range(rows):
 
-            time = data[i, 0]
-            theta = data[i, 1]
+# Extracts the GTIs where the theta angle of every body is above its threshold.
+# thresholds is a dict with the threshold of each body ("SUN", "MOON" or "EARTH"),
+# the bodies with None as threshold are not used, at least one is needed.
+# If path is given it must be a Theta_Phi file with the theta angles of all the
+# bodies, like TP_SME_FILE, else the GTIs of each BODY-Theta_Phi file are crossed.
+def get_bodies_gtis(thresholds, path=None):
 
-            if theta > threshold:
-                # We are inside a GTI
-                if gtiStart > 0:
-                    gtiEnd = time
-                else:
-                    gtiStart = time
+    bodies = [ body for body in thresholds if thresholds[body] is not None ]
+    if len(bodies) == 0:
+        raise ValueError("At least one body threshold is needed")
 
-            elif (gtiStart > 0) and (gtiStart < gtiEnd):
-                # We are closing a GTI
-                gtis.extend([[gtiStart, gtiEnd]])
-                gtiStart = -1
-                gtiEnd = -1
+    if path is not None:
+        data = cacheHelper.loadtxt(path, delimiter=",", ndmin=2)
+        mask = np.ones(len(data), dtype=bool)
+        for body in bodies:
+            mask &= data[:, consts.TP_SME_THETA_COLS[body]] > thresholds[body]
+        return get_gtis_from_mask(data[:, 0], mask)
 
-    return gtis
+    return gtiHelper.cross_gtis([ get_gtis_from_file(consts.TP_BODY_FILES[body], thresholds[body])
+                                  for body in bodies ])
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Reader of the Apollo 15 XRFS tables of the NASA PDS (ex: A15C_XRFS_71_EXTENDED_2.tab)
+#
+# Each row is one 8 seconds observation with 45 columns separated by spaces:
+#   MODE: detector mode (144 or 224)
+#   TIME: Ground Elapsed Time in seconds
+#   AUX_1 .. AUX_7: spacecraft position and angles (AUX_2 and AUX_3 match the
+#                   latitude and longitude of the lunar orbit)
+#   DET1, DET2, DET3: counts of the 8 channels of each proportional counter
+#                     (_CH0 .. _CH7) and one auxiliary value (_AUX)
+#   SM: counts of the 8 channels of the solar monitor and one auxiliary value
+#
+# The table is read into a structured array with one named field per column,
+# so the columns are accessed as tab["TIME"] or tab["DET1_CH7"].
+
+import numpy as np
+from utils import cache_helper as cacheHelper
+import constants as consts
+
+XRFS_TAB_DETECTORS = [ "DET1", "DET2", "DET3", "SM" ]
+XRFS_TAB_NUM_CHANNELS = 8
+
+# Column names and types of the XRFS tables, in file order
+XRFS_TAB_SCHEMA = ([ ("MODE", np.int16), ("TIME", np.float64) ]
+                   + [ ("AUX_" + str(idx), np.float64) for idx in range(1, 8) ]
+                   + [ (detector + "_" + column, np.int32)
+                       for detector in XRFS_TAB_DETECTORS
+                       for column in [ "CH" + str(ch) for ch in range(XRFS_TAB_NUM_CHANNELS) ] + [ "AUX" ] ])
+
+XRFS_TAB_DTYPE = np.dtype(XRFS_TAB_SCHEMA)
+
+
+def parse_xrfs_tab(path):
+    return np.loadtxt(path, dtype=XRFS_TAB_DTYPE, ndmin=1)
+
+
+# Loads a XRFS table, parsing it only the first time (see cache_helper)
+def load_xrfs_tab(path):
+    return cacheHelper.load_cached(parse_xrfs_tab, path)
+
+
+# Returns the counts of the channels (rows x channels) summed over the given detectors
+def get_channel_counts(tab, detectors):
+
+    counts = np.zeros((len(tab), XRFS_TAB_NUM_CHANNELS))
+    for detector in detectors:
+        if detector not in XRFS_TAB_DETECTORS:
+            raise ValueError("Unknown detector: " + str(detector))
+        for ch in range(XRFS_TAB_NUM_CHANNELS):
+            counts[:, ch] += tab[detector + "_CH" + str(ch)]
+
+    return counts
+
+
+# Converts a XRFS table to the ligthcurve format of LC_FILE: time in hours (GET),
+# mode and the counts of each channel summed over the given detectors
+def xrfs_tab_to_ligthcurve(tab, detectors=None):
+
+    detectors = consts.LC_PDS_DETECTORS if detectors is None else detectors
+
+    lc = np.zeros((len(tab), 2 + XRFS_TAB_NUM_CHANNELS))
+    lc[:, 0] = tab["TIME"] / 3600.0
+    lc[:, 1] = tab["MODE"]
+    lc[:, 2:] = get_channel_counts(tab, detectors)
+
+    return lc
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# FORCED PHOTOMETRY
+# ===============================================
+# Measures the flux of the all sky maps at the positions of a catalogue of
+# sources (see source_helper.load_catalog), all the sources at once.
+#
+# Methods:
+#   bilinear: interpolates the energy (or counts) and exposure maps between
+#             the centers of the four nearest pixels.
+#   aperture: averages the energy (or counts) and exposure maps weighted by the
+#             MRSC centered on the source, rotated on the sphere as in
+#             healpix_map_helper. The maps are sampled (bilinear) at the
+#             positions of the non zero MRSC elements every APERTURE_STEP
+#             degrees, the maps are smoothed by the MRSC so a finer step
+#             gives the same values.
+#
+# The value is the weighted energy divided by the weighted exposure, as the
+# flux map, and zero if the exposure is not above min_exposure. The error comes
+# from the Poisson variances of the values of the observations (from their
+# gross counts), projected on a variance map with the same MRSC and sampled
+# with the same method: sqrt(variance) / exposure. The variances are weighted
+# by the MRSC ratios as the exposure, so the error is exact for ratios of 1 and
+# an upper bound for lower ratios.
+# The HEALPix maps are sampled at the pixel containing each position.
+
+import os
+import numpy as np
+from utils import healpix_helper as hpHelper
+from utils import healpix_map_helper as hpMapHelper
+from utils import cache_helper as cacheHelper
+import constants as consts
+
+PHOTOMETRY_METHODS = [ "bilinear", "aperture" ]
+
+# Max number of map samples of the apertures computed at once
+APERTURE_CHUNK_SIZE = 1 << 22
+
+# Degrees between the MRSC elements sampled by the aperture method
+APERTURE_STEP = 1.0
+
+CSV_HEADER = 'Name, RA, Dec, Value, Exposure, Error'
+
+
+# Returns the values of a map at the coordinates. The CAR maps (Dec -90 in row 0
+# and RA 0 in column 0) are interpolated between the centers of the four nearest
+# pixels, periodic in RA. The HEALPix maps take the pixel containing each position
+def sample_map(img, ras, decs):
+
+    ras = np.asarray(ras, dtype=float)
+    decs = np.asarray(decs, dtype=float)
+
+    if img.ndim == 1:
+        return img[hpHelper.ang2pix(hpHelper.npix2nside(len(img)), ras, decs)]
+
+    height, width = img.shape
+    scale = width / 360.0
+
+    x = (ras % 360.0) * scale - 0.5
+    y = np.clip((decs + 90.0) * scale - 0.5, 0.0, height - 1.0)
+
+    x0 = np.floor(x).astype(int)
+    y0 = np.minimum(np.floor(y).astype(int), height - 2)
+    fx = x - x0
+    fy = y - y0
+    x1 = (x0 + 1) % width
+    x0 = x0 % width
+
+    return ((img[y0, x0] * (1.0 - fx) + img[y0, x1] * fx) * (1.0 - fy)
+            + (img[y0 + 1, x0] * (1.0 - fx) + img[y0 + 1, x1] * fx) * fy)
+
+
+# Returns the coordinates along the center, East and North axes of the pointing
+# (elements x 3) and the ratios of the non zero MRSC elements every step degrees.
+# kernel is the MRSC of width fov (degrees)
+def get_aperture_kernel(kernel=None, fov=None, step=APERTURE_STEP):
+
+    kernel = np.asarray(consts.MRSC if kernel is None else kernel, dtype=float) / 100.0
+    fov = consts.FOV if fov is None else fov
+    cell = float(fov) / kernel.shape[0]  # Degrees per MRSC element
+    stride = max(1, int(round(step / cell)))
+
+    rows, cols = np.nonzero(kernel)
+    row_offsets = rows - kernel.shape[0] // 2
+    col_offsets = cols - kernel.shape[0] // 2
+    sampled = (row_offsets % stride == 0) & (col_offsets % stride == 0)
+
+    # The ratios are looked up back from the coordinates, so the aperture is the same
+    # MRSC of the footprints of the maps
+    local_coords = hpMapHelper.get_kernel_coords(row_offsets[sampled] * cell, col_offsets[sampled] * cell)
+    return local_coords, hpMapHelper.get_kernel_ratios(local_coords, kernel, cell)
+
+
+# Returns the coordinates (sources x elements) of the elements of the aperture
+# kernel (see get_aperture_kernel) centered on each source
+def get_aperture_points(ras, decs, aperture_kernel):
+
+    local_coords = aperture_kernel[0]
+    axes = hpMapHelper.get_pointing_axes(ras, decs)
+    vectors = np.einsum("ej,nij->nei", local_coords, axes)
+    norms = np.sqrt(np.sum(vectors ** 2, axis=-1))
+
+    point_ras = np.degrees(np.arctan2(vectors[..., 1], vectors[..., 0])) % 360.0
+    point_decs = np.degrees(np.arcsin(np.clip(vectors[..., 2] / norms, -1.0, 1.0)))
+
+    return point_ras, point_decs
+
+
+# Returns the MRSC weighted mean of each map in the aperture of each source
+# (maps x sources)
+def get_aperture_means(maps, ras, decs, kernel=None, fov=None):
+
+    ras = np.atleast_1d(np.asarray(ras, dtype=float))
+    decs = np.atleast_1d(np.asarray(decs, dtype=float))
+
+    aperture_kernel = get_aperture_kernel(kernel, fov)
+    ratios = aperture_kernel[1] / np.sum(aperture_kernel[1])
+    chunk_size = max(1, APERTURE_CHUNK_SIZE // len(ratios))
+
+    means = np.zeros((len(maps), len(ras)))
+    for start in range(0, len(ras), chunk_size):
+        end = start + chunk_size
+
+        point_ras, point_decs = get_aperture_points(ras[start:end], decs[start:end], aperture_kernel)
+        for map_idx, img in enumerate(maps):
+            means[map_idx, start:end] = np.dot(sample_map(img, point_ras, point_decs), ratios)
+
+    return means
+
+
+# Measures the sources at the given coordinates over the energy (or counts), variance
+# and exposure maps. Returns a dictionary with the value, exposure and error of each
+# source. min_exposure is MIN_EXPOSURE by default
+def forced_photometry(values_map, variance_map, exposure_map, ras, decs, method="aperture",
+                      min_exposure=None):
+
+    min_exposure = consts.MIN_EXPOSURE if min_exposure is None else min_exposure
+    maps = [ values_map, variance_map, exposure_map ]
+
+    if method == "bilinear":
+        values, variances, exposures = [ sample_map(img, ras, decs) for img in maps ]
+    elif method == "aperture":
+        values, variances, exposures = get_aperture_means(maps, ras, decs)
+    else:
+        raise ValueError("Unknown photometry method: " + str(method))
+
+    valid = exposures > min_exposure
+    flux = np.zeros(len(values))
+    np.divide(values, exposures, out=flux, where=valid)
+
+    # The FFT convolutions can leave tiny negative variances
+    errors = np.zeros(len(values))
+    np.divide(np.sqrt(np.maximum(variances, 0.0)), exposures, out=errors, where=valid)
+
+    return { "value": flux, "exposure": exposures, "error": errors }
+
+
+# Saves the photometry of the sources of the catalogue as a CSV file, creating
+# its folder if doesn't exist
+def save_photometry(filename, catalog, photometry):
+
+    cacheHelper.make_folder(os.path.dirname(filename))
+
+    rows = np.empty((len(catalog), 6), dtype=object)
+    rows[:, 0] = catalog["name"]
+    rows[:, 1] = catalog["ra"]
+    rows[:, 2] = catalog["dec"]
+    rows[:, 3] = photometry["value"]
+    rows[:, 4] = photometry["exposure"]
+    rows[:, 5] = photometry["error"]
+
+    np.savetxt(filename, rows, delimiter=",", header=CSV_HEADER,
+               fmt=[ '%s', '%10.6f', '%10.6f', '%12.6g', '%12.6g', '%12.6g' ])
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# SKY ACCUMULATOR
+# ===============================================
+# Accumulates the observations of a ligthcurve read in chunks over the all sky
+# maps. Each chunk is only binned on the map pixels (values per channel and
+# number of observations), and the MRSC is applied once to the accumulated bins
+# when the maps are requested. So the memory used is the bins plus one chunk,
+# whatever the length of the ligthcurve.
+#
+# The projection is linear, so the maps are the same as projecting all the
+# observations at once. With the "scatter" method the bins are convolved with
+# the "auto" method, that gives the same maps.
+#
+# The bins can be saved as a checkpoint (.npz) and loaded in the next runs, so only
+# the new observations have to be binned, and observations can be removed binning
+# them with sign -1. The checkpoint records the rows already binned as segments
+# of the ligthcurve: (end time, gtis), the rows with time until the end time of
+# the first segment and inside its gtis, the rest until the end time of the next
+# segment and inside its gtis... The end time of the last segment is the watermark,
+# the rows after it were never binned.
+# The checkpoint also has a hash of the configuration, it isn't loaded if the
+# configuration is not the same.
+
+import os
+import numpy as np
+from utils import ligthcurve_helper as lcHelper
+from utils import img_helper as imgHelper
+from utils import healpix_helper as hpHelper
+from utils import healpix_map_helper as hpMapHelper
+from utils import cache_helper as cacheHelper
+import constants as consts
+
+BACKENDS = [ "car", "healpix" ]
+
+# Version of the checkpoint files, the checkpoints of other versions are not loaded
+CHECKPOINT_VERSION = 1
+
+
+class SkyAccumulator(object):
+
+    # channels: number of values of each observation
+    # backend: "car" or "healpix" (see PROJECTION_BACKEND)
+    # nside: nside of the HEALPix maps, None for choosing it from IMG_SCALE
+    # method: projection method of the CAR maps (see PROJECTION_METHOD)
+    def __init__(self, channels, backend="car", nside=None, method="auto"):
+
+        if backend not in BACKENDS:
+            raise ValueError("Unknown projection backend: " + str(backend))
+
+        self.channels = channels
+        self.backend = backend
+        self.method = "auto" if method == "scatter" else method
+        self.samples = 0
+
+        if backend == "healpix":
+            self.nside = nside or hpMapHelper.get_nside(consts.IMG_SCALE)
+            shape = (hpHelper.nside2npix(self.nside),)
+        else:
+            self.nside = None
+            shape = (imgHelper.MAX_H, imgHelper.MAX_W)
+
+        self.values_bins = np.zeros((channels,) + shape)
+        self.counts_bins = np.zeros(shape)
+        self.segments = []
+
+    # Time until the ligthcurve rows were binned, -inf if none
+    @property
+    def watermark(self):
+        return self.segments[-1][0] if len(self.segments) else -np.inf
+
+    # Returns the mask of the ligthcurve rows (sorted times) already binned
+    def is_projected(self, times):
+
+        mask = np.zeros(len(times), dtype=bool)
+        start = 0
+        for end_time, gtis in self.segments:
+            end = np.searchsorted(times, end_time, side="right")
+            if end > start:
+                mask[start:end] = lcHelper.get_gti_mask(times[start:end], gtis)
+            start = max(start, end)
+
+        return mask
+
+    # Records that the ligthcurve rows until end_time inside the gtis are binned,
+    # and the rest of rows as before
+    def set_projected(self, end_time, gtis):
+
+        segments = [ (end_time, np.asarray(gtis, dtype=float).reshape((-1, 2))) ]
+        segments.extend([ segment for segment in self.segments if segment[0] > end_time ])
+
+        # A segment with the same gtis as the next one is included in it
+        self.segments = [ segment for segment, next_segment in zip(segments, segments[1:] + [ None ])
+                          if next_segment is None or not np.array_equal(segment[1], next_segment[1]) ]
+
+    # Bins the observations of a chunk, values has one column per channel.
+    # With sign -1 the observations are removed from the bins
+    def add(self, ras, decs, values, sign=1):
+
+        values = np.asarray(values, dtype=float).reshape((len(ras), self.channels))
+        if len(values) == 0:
+            return
+
+        if self.backend == "healpix":
+            values_bins, counts_bins = hpMapHelper.binObservationsHealpix(ras, decs, values, self.nside)
+        else:
+            ras_int = (np.asarray(ras) * consts.IMG_SCALE).astype(np.int64)
+            decs_int = ((np.asarray(decs) + 90.0) * consts.IMG_SCALE).astype(np.int64)
+            values_bins, counts_bins = imgHelper.binObservations(ras_int, decs_int, values)
+
+        if sign > 0:
+            self.values_bins += values_bins
+            self.counts_bins += counts_bins
+        else:
+            self.values_bins -= values_bins
+            self.counts_bins -= counts_bins
+        self.samples += sign * len(values)
+
+    # Returns the cube (channels x map) and the exposure map of the observations added
+    def get_maps(self):
+
+        if self.backend == "healpix":
+            return hpMapHelper.convolveFootprints(self.values_bins, self.counts_bins)
+
+        return imgHelper.convolveBins(self.values_bins, self.counts_bins, self.method)
+
+    # Saves the bins and the segments binned as a checkpoint, an interrupted save
+    # doesn't break the previous checkpoint (see cache_helper.save_file)
+    def save(self, path, config_hash):
+
+        ends = np.array([ segment[0] for segment in self.segments ], dtype=float)
+        gtis_sizes = np.array([ len(segment[1]) for segment in self.segments ], dtype=int)
+        gtis = np.concatenate([ segment[1] for segment in self.segments ]) if len(self.segments) \
+                    else np.zeros((0, 2))
+
+        arrays = dict(version=CHECKPOINT_VERSION, config_hash=config_hash,
+                      backend=self.backend, nside=self.nside or 0, method=self.method,
+                      values_bins=self.values_bins, counts_bins=self.counts_bins,
+                      samples=self.samples, segment_ends=ends,
+                      segment_gtis_sizes=gtis_sizes, segment_gtis=gtis)
+        cacheHelper.save_file(path, arrays, save=lambda checkpoint_file, arrays: np.savez(checkpoint_file, **arrays))
+
+
+# Loads a checkpoint saved with SkyAccumulator.save, returns None if the file doesn't
+# exist or it is from other version or configuration
+def load(path, config_hash):
+
+    if path is None or not os.path.isfile(path):
+        return None
+
+    with np.load(path) as checkpoint:
+        if int(checkpoint["version"]) != CHECKPOINT_VERSION \
+                or str(checkpoint["config_hash"]) != config_hash:
+            return None
+
+        nside = int(checkpoint["nside"]) or None
+        accumulator = SkyAccumulator(checkpoint["values_bins"].shape[0],
+                                     backend=str(checkpoint["backend"]), nside=nside,
+                                     method=str(checkpoint["method"]))
+
+        if accumulator.values_bins.shape != checkpoint["values_bins"].shape:
+            return None
+
+        accumulator.values_bins = checkpoint["values_bins"]
+        accumulator.counts_bins = checkpoint["counts_bins"]
+        accumulator.samples = int(checkpoint["samples"])
+
+        gtis = np.split(checkpoint["segment_gtis"], np.cumsum(checkpoint["segment_gtis_sizes"])[:-1])
+        accumulator.segments = list(zip(checkpoint["segment_ends"].tolist(), gtis))
+
+    return accumulator
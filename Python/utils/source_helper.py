@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# SOURCE LIGTHCURVES
+# ===============================================
+# Finds the observations whose FOV contains a given source, for many sources at
+# once. The pointings of the observations are indexed once in a KD-tree of
+# their unit vectors, and the candidates of each source are the pointings
+# closer than the radius of the MRSC. The MRSC ratio of each candidate is
+# looked up from the angular offsets of the source to the pointing along the
+# local East and North directions (as in healpix_map_helper), and the
+# observations with zero ratio are dismissed.
+#
+# The catalogue is a CSV file with the columns: Name, RA, Dec (degrees).
+
+import numpy as np
+import scipy.spatial
+from utils import healpix_helper as hpHelper
+from utils import healpix_map_helper as hpMapHelper
+import constants as consts
+
+CATALOG_DTYPE = [ ("name", "U64"), ("ra", float), ("dec", float) ]
+
+# Max number of candidate observations of the sources computed at once
+QUERY_CHUNK_SIZE = 1 << 22
+
+
+# Loads the catalogue as a structured array with the fields name, ra and dec
+def load_catalog(path):
+    return np.atleast_1d(np.genfromtxt(path, delimiter=",", skip_header=1, autostrip=True,
+                                       dtype=CATALOG_DTYPE, encoding="utf-8"))
+
+
+# Spatial index of the pointings of the observations
+class PointingIndex(object):
+
+    # kernel is the MRSC of width fov (degrees)
+    def __init__(self, ras, decs, kernel=None, fov=None):
+
+        self.kernel = np.asarray(consts.MRSC if kernel is None else kernel, dtype=float) / 100.0
+        fov = consts.FOV if fov is None else fov
+        self.cell = float(fov) / self.kernel.shape[0]  # Degrees per MRSC element
+        self.cos_radius = hpMapHelper.get_kernel_cos_radius(self.kernel, self.cell)
+
+        self.axes = hpMapHelper.get_pointing_axes(ras, decs)
+        self.tree = scipy.spatial.cKDTree(self.axes[:, :, 0])
+
+    def __len__(self):
+        return len(self.axes)
+
+    # Returns the MRSC ratios of the sources (unit vectors) for the given pointings
+    def get_ratios(self, sources, pointings):
+
+        local = np.einsum("ni,nij->nj", sources, self.axes[pointings])
+        return hpMapHelper.get_kernel_ratios(local, self.kernel, self.cell)
+
+    # Returns the source indices, observation indices and MRSC ratios of the
+    # observations whose FOV contains each source, grouped by source in time order.
+    # The sources are processed in chunks of about QUERY_CHUNK_SIZE candidates
+    def query(self, ras, decs):
+
+        sources = hpHelper.ang2vec(np.asarray(ras, dtype=float), np.asarray(decs, dtype=float)).reshape((-1, 3))
+
+        # Chord length of the MRSC radius
+        chord = np.sqrt(2.0 * (1.0 - self.cos_radius))
+        counts = np.atleast_1d(self.tree.query_ball_point(sources, chord, return_length=True))
+
+        results = []
+        start = 0
+        while start < len(sources):
+            end = start + max(1, np.searchsorted(np.cumsum(counts[start:]), QUERY_CHUNK_SIZE, side="right"))
+
+            neighbours = self.tree.query_ball_point(sources[start:end], chord)
+            source_idx = np.repeat(np.arange(start, end), counts[start:end])
+            pointings = np.concatenate([ np.asarray(pointings, dtype=int) for pointings in neighbours ])
+
+            ratios = self.get_ratios(sources[source_idx], pointings)
+            valid = ratios > 0
+            results.append((source_idx[valid], pointings[valid], ratios[valid]))
+            start = end
+
+        if len(results) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+
+        source_idx, pointings, ratios = [ np.concatenate(values) for values in zip(*results) ]
+        order = np.lexsort((pointings, source_idx))
+        return source_idx[order], pointings[order], ratios[order]
+
+
+# Returns the rows of the data (one row per observation) of each source of the catalogue,
+# with the MRSC ratio of the source as last column, as a list of arrays. ras and decs
+# are the pointings of the observations
+def get_source_rows(catalog, data, ras, decs, index=None):
+
+    index = PointingIndex(ras, decs) if index is None else index
+    source_idx, samples, ratios = index.query(catalog["ra"], catalog["dec"])
+
+    rows = np.column_stack((data[samples], ratios))
+    splits = np.cumsum(np.bincount(source_idx, minlength=len(catalog)))[:-1]
+    return np.split(rows, splits)
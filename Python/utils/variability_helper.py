@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# PIXEL VARIABILITY
+# ===============================================
+# Groups the observations by sky pixel of pix_size degrees, keeping the time
+# series of each pixel in CSR form: the samples of the pixel i are
+# samples[offsets[i]:offsets[i + 1]], in time order. So the memory used is
+# proportional to the number of samples, not to pixels x max samples by pixel.
+#
+# The pixel of an observation is (int(dec + 90) // pix_size, int(ra) // pix_size)
+# and its id is dec_idx * number of RA pixels + ra_idx. The pixels are ordered
+# by their first observation.
+#
+# Several pixel sizes (integer degrees) are computed at once from the pixels of
+# 1 degree, that are nested in the pixels of every size: the first observation
+# and the number of observations of each pixel are taken from its 1 degree
+# pixels, and the samples are grouped with a stable sort of 16 bits keys
+# (radix sort) per pixel size. The outputs of each size are written in parallel.
+#
+# The variability statistics of all the pixels are computed at once with segmented
+# sums (np.add.reduceat) over the samples grouped by pixel:
+#   mean, var: mean and sample variance of the energies.
+#   chi2, dof: chi square of the energies against their weighted mean (constant
+#              source) with the Poisson errors of the energies, and its degrees of freedom.
+#   pvalue: probability of a chi square as high for a constant source.
+#   nxs, fvar: normalized excess variance (var - mean square error) / mean^2, and
+#              the fractional variability sqrt(nxs), zero if nxs is negative.
+# The pixels with one sample have NaN statistics.
+
+import multiprocessing
+import numpy as np
+import scipy.stats
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import utils.exception_helper as ExHelper
+from utils import cache_helper as cacheHelper
+import constants as consts
+
+# Number of Dec and RA pixels of 1 degree
+FINE_SHAPE = (180, 360)
+
+CSV_HEADER = 'RA, Dec, Time, Ch0, Ch1, Ch2, Ch3, Ch4, Ch5, Ch6, Ch7, Total'
+
+STATS_COLUMNS = [ "count", "mean", "var", "chi2", "dof", "pvalue", "nxs", "fvar" ]
+STATS_HEADER = 'RA, Dec, ' + ', '.join(name.capitalize() for name in STATS_COLUMNS)
+
+
+# Returns the number of Dec and RA pixels of the sky
+def get_grid_shape(pix_size):
+    return (180 + pix_size - 1) // pix_size, (360 + pix_size - 1) // pix_size
+
+
+# Returns the ids of the pixels of 1 degree of the coordinates (16 bits)
+def get_fine_ids(ras, decs):
+
+    ras_int = np.minimum(np.asarray(ras).astype(int), FINE_SHAPE[1] - 1)
+    decs_int = np.minimum((np.asarray(decs) + 90.0).astype(int), FINE_SHAPE[0] - 1)
+
+    return (decs_int * FINE_SHAPE[1] + ras_int).astype(np.uint16)
+
+
+# Returns the id of the pixel of pix_size containing each pixel of 1 degree
+def get_coarse_ids(pix_size):
+
+    if int(pix_size) != pix_size or pix_size < 1:
+        raise ValueError("Pixel size must be a positive integer: " + str(pix_size))
+
+    decs_int, ras_int = np.indices(FINE_SHAPE)
+    n_ras = get_grid_shape(pix_size)[1]
+    return ((decs_int // pix_size) * n_ras + ras_int // pix_size).ravel()
+
+
+# Time series of the samples of each sky pixel in CSR form
+class PixelTimeSeries(object):
+
+    # pixels: pixel ids ordered by first sample, offsets: start of the samples of
+    # each pixel and the end, samples: indices of the samples grouped by pixel
+    def __init__(self, pixels, offsets, samples, pix_size):
+        self.pixels = pixels
+        self.offsets = offsets
+        self.samples = samples
+        self.pix_size = pix_size
+
+    # Groups the samples by the rank of their pixel in pixels
+    @classmethod
+    def from_ranks(cls, pixels, sample_ranks, pix_size):
+
+        samples = np.argsort(sample_ranks, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(sample_ranks, minlength=len(pixels)))))
+        return cls(pixels, offsets, samples, pix_size)
+
+    def __len__(self):
+        return len(self.pixels)
+
+    # Number of samples of each pixel
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    # Values of the samples of the pixel idx
+    def get_series(self, idx, values):
+        return values[self.samples[self.offsets[idx]:self.offsets[idx + 1]]]
+
+    # Returns the RA and Dec (0..180) of each pixel
+    def get_pixel_coords(self):
+
+        n_ras = get_grid_shape(self.pix_size)[1]
+        offset = self.pix_size // 2
+        return (self.pixels % n_ras) * self.pix_size + offset, (self.pixels // n_ras) * self.pix_size + offset
+
+    # Returns the RA and Dec (0..180) of the pixel of each sample, in CSR order
+    def get_sample_coords(self):
+        ras, decs = self.get_pixel_coords()
+        return np.repeat(ras, self.counts), np.repeat(decs, self.counts)
+
+    # Returns the segmented sums of the grouped values (values[samples]) of each pixel
+    def sum_grouped(self, grouped):
+        if len(grouped) == 0:
+            return np.zeros(0)
+        return np.add.reduceat(grouped, self.offsets[:-1])
+
+    # Returns a dictionary with the variability statistics of each pixel (see
+    # STATS_COLUMNS) from the values of the samples and their errors
+    def get_statistics(self, values, errors):
+
+        counts = self.counts
+        values = np.asarray(values, dtype=float)[self.samples]
+        errors = np.asarray(errors, dtype=float)[self.samples]
+
+        weights = np.zeros(len(values))
+        np.divide(1.0, errors ** 2, out=weights, where=errors > 0)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum_grouped(values) / counts
+            deviations = values - np.repeat(mean, counts)
+            var = self.sum_grouped(deviations ** 2) / (counts - 1)
+
+            # Chi square against the weighted mean
+            weighted_mean = self.sum_grouped(weights * values) / self.sum_grouped(weights)
+            chi2 = self.sum_grouped(weights * (values - np.repeat(weighted_mean, counts)) ** 2)
+            dof = counts - 1
+
+            mse = self.sum_grouped(errors ** 2) / counts
+            nxs = (var - mse) / mean ** 2
+
+        single = counts < 2
+        chi2[single] = np.nan
+        pvalue = np.where(single, np.nan, scipy.stats.chi2.sf(chi2, np.maximum(dof, 1)))
+
+        return { "count": counts, "mean": mean, "var": var, "chi2": chi2, "dof": dof,
+                 "pvalue": pvalue, "nxs": nxs, "fvar": np.sqrt(np.maximum(nxs, 0.0)) }
+
+    # Returns the table of the statistics of the pixels (see STATS_HEADER), ranked from
+    # the most variable (lowest pvalue, then highest fvar), the NaNs at the end
+    def get_statistics_table(self, values, errors):
+
+        stats = self.get_statistics(values, errors)
+        ras, decs = self.get_pixel_coords()
+        table = np.column_stack([ ras, decs ] + [ stats[name] for name in STATS_COLUMNS ])
+
+        pvalues = np.where(np.isnan(stats["pvalue"]), np.inf, stats["pvalue"])
+        fvars = np.where(np.isnan(stats["fvar"]), 0.0, stats["fvar"])
+        return table[np.lexsort((-fvars, pvalues))]
+
+    # Returns the values as a dense array (pixels x max samples by pixel) padded with zeros
+    def get_padded(self, values):
+
+        counts = self.counts
+        padded = np.zeros((len(self), np.max(counts) if len(counts) else 0))
+        columns = np.arange(len(self.samples)) - np.repeat(self.offsets[:-1], counts)
+        padded[np.repeat(np.arange(len(self)), counts), columns] = values[self.samples]
+        return padded
+
+    # Returns the CSV rows of the samples grouped by pixel: RA, Dec, time,
+    # channels and energy. lc is the ligthcurve data of the samples
+    def get_csv_rows(self, lc, energies):
+
+        ras, decs = self.get_sample_coords()
+        channels = lc[self.samples, consts.LC_FIRST_CHANNEL_COL:consts.LC_FIRST_CHANNEL_COL + consts.LC_NUM_CHANNELS]
+
+        return np.column_stack((ras, decs, lc[self.samples, consts.LC_TIME_COL],
+                                channels, energies[self.samples]))
+
+
+# Returns the PixelTimeSeries of the samples with energy above min_energy
+# (VARIABILITY_MIN_ENERGY by default), and the map with the number of observations
+# of each pixel (all the samples)
+def get_variability(ras, decs, energies, pix_size, min_energy=None):
+    return get_multi_variability(ras, decs, energies, [ pix_size ], min_energy)[pix_size]
+
+
+# Same as get_variability for several pixel sizes computed at once, returns a
+# dictionary with the PixelTimeSeries and overlap counts map of each pixel size
+def get_multi_variability(ras, decs, energies, pix_sizes, min_energy=None):
+
+    min_energy = consts.VARIABILITY_MIN_ENERGY if min_energy is None else min_energy
+
+    fine_ids = get_fine_ids(ras, decs)
+    fine_counts = np.bincount(fine_ids, minlength=FINE_SHAPE[0] * FINE_SHAPE[1])
+
+    valid = np.nonzero(energies > min_energy)[0]
+    valid_ids = fine_ids[valid]
+
+    # First valid sample of each pixel of 1 degree, len(valid) if none
+    order = np.argsort(valid_ids, kind="stable")
+    sorted_ids = valid_ids[order]
+    starts = np.nonzero(np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))[0] if len(order) \
+                else np.array([], dtype=int)
+    fine_first = np.full(len(fine_counts), len(valid), dtype=np.int64)
+    fine_first[sorted_ids[starts]] = order[starts]
+
+    results = {}
+    for pix_size in pix_sizes:
+        coarse_ids = get_coarse_ids(pix_size)
+        n_pixels = np.prod(get_grid_shape(pix_size))
+
+        # First sample of each pixel and rank of the pixels with samples
+        first = np.full(n_pixels, len(valid), dtype=np.int64)
+        np.minimum.at(first, coarse_ids, fine_first)
+        pixels = np.nonzero(first < len(valid))[0]
+        pixels = pixels[np.argsort(first[pixels], kind="stable")]
+
+        ranks = np.zeros(n_pixels, dtype=np.uint16)
+        ranks[pixels] = np.arange(len(pixels))
+
+        series = PixelTimeSeries.from_ranks(pixels, ranks[coarse_ids][valid_ids], pix_size)
+        series.samples = valid[series.samples]  # Sample indices of the whole ligthcurve
+
+        overlap_counts = np.bincount(coarse_ids, weights=fine_counts, minlength=n_pixels)
+        results[pix_size] = (series, overlap_counts.astype(int).reshape(get_grid_shape(pix_size)))
+
+    return results
+
+
+# Saves the CSV file of the time series of each pixel
+def save_variability_csv(filename, series, lc, energies):
+    np.savetxt(filename, series.get_csv_rows(lc, energies), delimiter=",", fmt='%10.6f', header=CSV_HEADER)
+
+
+# Saves the CSV file of the statistics of each pixel, ranked by variability
+def save_statistics_csv(filename, series, energies, energy_errors):
+    np.savetxt(filename, series.get_statistics_table(energies, energy_errors), delimiter=",",
+               fmt='%12.6g', header=STATS_HEADER)
+
+
+# Saves an image of the data with a color bar
+def save_image(filename, data):
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot(111)
+    figure.colorbar(axes.imshow(data), ax=axes)
+    figure.savefig(filename)
+
+
+# Saves the outputs of a pixel size in its folder:
+#   skyOverlapCounts.png: number of observations of each pixel
+#   variabilityMap.png: energy of the samples (X) of each pixel (Y)
+#   linePlot.png: one line with the energies of each pixel
+#   variability.csv: the samples grouped by pixel
+#   variabilityStats.csv: the statistics of each pixel ranked by variability
+# Returns the error message if fails
+def save_variability(args):
+
+    folder, series, overlap_counts, lc, energies, energy_errors = args
+    try:
+        cacheHelper.make_folder(folder)
+
+        save_image(folder + "skyOverlapCounts.png", overlap_counts)
+        save_image(folder + "variabilityMap.png", series.get_padded(energies))
+
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        for px_idx in range(len(series)):
+            axes.plot(series.get_series(px_idx, energies))
+        figure.savefig(folder + "linePlot.png")
+
+        save_variability_csv(folder + "variability.csv", series, lc, energies)
+        save_statistics_csv(folder + "variabilityStats.csv", series, energies, energy_errors)
+        return None
+
+    except:
+        return ExHelper.getWarnMsg()
+
+
+# Saves the outputs of each pixel size in output_folder/pixSize{pix_size}/
+# with a pool of workers processes (EXPORT_WORKERS by default)
+def save_multi_variability(results, lc, energies, energy_errors, output_folder,
+                           workers=None):
+
+    workers = consts.EXPORT_WORKERS if workers is None else workers
+
+    tasks = [ (output_folder + "pixSize" + str(pix_size) + "/", results[pix_size][0],
+               results[pix_size][1], lc, energies, energy_errors) for pix_size in sorted(results) ]
+
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            errors = pool.map(save_variability, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = [ save_variability(task) for task in tasks ]
+
+    for task, error in zip(tasks, errors):
+        if error is None:
+            print('Saved variability of ' + str(len(task[1])) + ' pixels in: ' + task[0])
+        else:
+            print('Failed: ' + task[0] + ': ' + error)